@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process acquisition / compute / render pipeline
+
+The exercises normally pull the EEG, filter it, compute the features,
+classify and redraw the plots one after the other, so a slow redraw delays
+everything else. In pipeline mode, acquisition and computation each run in
+their own process and the script's main process only renders:
+
+    acquisition --(raw chunks)--> compute --(results)--> render
+
+The stages are connected by bounded queues and each runs at its own rate.
+When compute falls behind, the raw chunks accumulate in the queue and are
+processed together with the next one; acquisition only waits when the queue
+is full, and the LSL inlet keeps buffering meanwhile. When the render stage
+does not collect the results in time, the queued ones are merged into the
+next result, keeping all their EEG, features and decisions, so a slow
+redraw only lowers the frame rate of the plots and never the rate of the
+decisions. Every queue counts the items put, dropped or merged and the
+times it was full, see Pipeline.get_stats.
+"""
+
+import multiprocessing as mp
+import queue
+
+import numpy as np
+from pylsl import StreamInlet, resolve_byprop, local_clock
+
+import bci_workshop_tools as BCIw
+
+
+# Start the stages from a fresh interpreter, forking a process that already
+# opened matplotlib windows is not safe
+_mp = mp.get_context('spawn')
+
+
+class BoundedQueue():
+    """
+    Process-safe queue of bounded size, with backpressure counters.
+
+    When the queue is full, put() either drops the oldest item to make room
+    (drop=True) or waits for the consumer (drop=False). With a "merge"
+    function, put() merges all the queued items into the new one instead of
+    dropping them.
+    """
+
+    # Indices of the counters
+    PUT, DROPPED, FULL = range(3)
+
+    def __init__(self, maxsize, drop=True, merge=None):
+        self.maxsize = maxsize
+        self.drop = drop
+        self.merge = merge
+        self._queue = _mp.Queue(maxsize)
+        self._counters = _mp.Array('l', 3)
+
+    def _count(self, counter):
+        with self._counters.get_lock():
+            self._counters[counter] += 1
+
+    def put(self, item, timeout=1.):
+        """Put an item, return False if it timed out waiting for room."""
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._count(self.FULL)
+            while True:
+                if self.merge is not None:
+                    item = self._merge_queued(item)
+                elif self.drop:
+                    # Items put by this process may still be on their way
+                    # to the pipe, so wait a little for the oldest one
+                    try:
+                        self._queue.get(timeout=0.01)
+                        self._count(self.DROPPED)
+                    except queue.Empty:
+                        pass
+                try:
+                    self._queue.put(item, timeout=0.01 if self.drop
+                                    else timeout)
+                    break
+                except queue.Full:
+                    if not self.drop:
+                        return False
+        self._count(self.PUT)
+        return True
+
+    def _merge_queued(self, item):
+        """Take the queued items out and merge them into "item", in order."""
+        older = []
+        while True:
+            # Items put by this process may still be on their way to the
+            # pipe, so wait a little for each of them
+            try:
+                older.append(self._queue.get(timeout=0.01))
+                self._count(self.DROPPED)
+            except queue.Empty:
+                break
+        for queued in reversed(older):
+            item = self.merge(queued, item)
+        return item
+
+    def get(self, timeout=None):
+        """Get an item, or None if nothing came within "timeout" seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_all(self, timeout=None):
+        """Wait up to "timeout" seconds for one item, then take all of them.
+
+        Returns:
+            (list): items, oldest first
+        """
+        item = self.get(timeout)
+        if item is None:
+            return []
+        items = [item]
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def get_stats(self):
+        """Return the counters and the approximate number of items queued."""
+        with self._counters.get_lock():
+            counters = list(self._counters)
+        try:
+            size = self._queue.qsize()
+        except NotImplementedError:  # macOS
+            size = -1
+        return {'put': counters[self.PUT], 'dropped': counters[self.DROPPED],
+                'full': counters[self.FULL], 'size': size}
+
+    def close(self):
+        # Do not wait for the items left to be consumed when exiting
+        self._queue.cancel_join_thread()
+        self._queue.close()
+
+
+def merge_results(older, newer):
+    """Merge a result of the compute stage into the next one.
+
+    The EEG, features and decisions of both are kept, oldest first, the
+    other fields are those of "newer". Merged results hold the features
+    as rows of a 2D array.
+    """
+    merged = dict(newer)
+    merged['eeg'] = np.concatenate((older['eeg'], newer['eeg']))
+    merged['features'] = np.vstack((older['features'], newer['features']))
+    if newer['decision'] is not None:
+        merged['decision'] = np.concatenate((older['decision'],
+                                             newer['decision']))
+    return merged
+
+
+def stream_selector(info):
+    """Return the (property, value) pair that selects the stream of "info".
+
+    Used to open the same stream in the acquisition process, as stream
+    information cannot be passed between processes.
+    """
+    if info.source_id():
+        return 'source_id', info.source_id()
+    return 'name', info.name()
+
+
+def acquire(selector, index_channel, max_samples, dtype, output, stop):
+    """Acquisition stage: pull chunks from LSL and queue them.
+
+    Args:
+        selector (tuple): (property, value) of the stream, see resolve_byprop
+        index_channel (list): indices of the channels kept
+        max_samples (int): maximum number of samples of a chunk
+        dtype (numpy.dtype): type of the data of the chunks
+        output (BoundedQueue): raw chunks, as tuples (data, timestamps)
+            with the timestamps in the local clock
+        stop (multiprocessing.Event): set to end the stage
+    """
+    try:
+        streams = resolve_byprop(selector[0], selector[1], timeout=2)
+        if len(streams) == 0:
+            raise RuntimeError('Can\'t find EEG stream.')
+        inlet = StreamInlet(streams[0], max_chunklen=12)
+        time_correction = inlet.time_correction()
+
+        while not stop.is_set():
+            eeg_data, timestamp = inlet.pull_chunk(timeout=0.1,
+                                                   max_samples=max_samples)
+            if not timestamp:
+                continue
+            chunk = (np.array(eeg_data, dtype=dtype)[:, index_channel],
+                     np.array(timestamp) + time_correction)
+            # Wait for compute rather than losing samples, the inlet keeps
+            # buffering in the meantime
+            while not output.put(chunk) and not stop.is_set():
+                pass
+
+    except KeyboardInterrupt:
+        pass
+    finally:
+        output.close()
+
+
+def compute(fs, n_channels, epoch_length, classifier, plan, dtype, input_,
+            output, stop, stats):
+    """Compute stage: filter, compute the features and classify.
+
+    Chunks queued while the previous one was processed are handled
+    together, so only the newest epoch is used when the stage falls behind.
+
+    Args:
+        fs (float): sampling frequency
+        n_channels (int): number of channels of the chunks
+        epoch_length (float): length of the epochs in seconds
+        classifier (tuple): (clf, mu_ft, std_ft) as returned by
+            train_classifier, or None to only compute the features
+        plan (FeaturePlan): features to extract, None for the default
+        dtype (numpy.dtype): type of the filtered EEG and the features
+        input_ (BoundedQueue): raw chunks from the acquisition stage
+        output (BoundedQueue): one dict per processed chunk, with the new
+            filtered EEG ('eeg', at most one epoch), the feature vector
+            ('features'), the decision ('decision', None without
+            classifier) and the 'latency' of the stage. See merge_results
+            for the results merged when the queue is full.
+        stop (multiprocessing.Event): set to end the stage
+        stats (multiprocessing.Array): number of chunks processed and of
+            chunks handled together with a newer one
+    """
+    n_epoch = int(epoch_length * fs)
+    eeg_buffer = BCIw.RingBuffer(n_epoch, n_channels, notch=True, fs=fs,
+                                 dtype=dtype)
+    band_power = BCIw.SlidingBandPower(n_epoch, n_channels, fs, plan=plan,
+                                       dtype=dtype)
+    evaluator = None
+    if classifier is not None:
+        evaluator = BCIw.CompiledClassifier(*classifier)
+
+    try:
+        while not stop.is_set():
+            chunks = input_.get_all(timeout=0.1)
+            if not chunks:
+                continue
+            t_start = local_clock()
+            eeg_data = np.concatenate([chunk[0] for chunk in chunks])
+            timestamp = chunks[-1][1][-1]
+
+            eeg_buffer.update(eeg_data)
+            eeg_filtered = eeg_buffer.get_last_data(
+                    min(len(eeg_data), n_epoch)).copy()
+            t_filtered = local_clock()
+
+            feat_vector = band_power.update(eeg_filtered)
+            t_features = local_clock()
+
+            decision = None
+            if evaluator is not None:
+                decision = evaluator.predict(feat_vector.reshape(1, -1))
+            t_decision = local_clock()
+
+            with stats.get_lock():
+                stats[0] += len(chunks)
+                stats[1] += len(chunks) - 1
+            output.put({'eeg': eeg_filtered, 'features': feat_vector,
+                        'decision': decision, 'timestamp': timestamp,
+                        'latency': {'filtering': t_filtered - t_start,
+                                    'features': t_features - t_filtered,
+                                    'prediction': t_decision - t_features,
+                                    'sample age': t_decision - timestamp}})
+
+    except KeyboardInterrupt:
+        pass
+    finally:
+        output.close()
+
+
+class Pipeline():
+    """
+    Run the acquisition and compute stages in their own processes.
+
+    The main process collects the results with get_results() and renders
+    them at its own pace.
+    """
+
+    def __init__(self, selector, fs, index_channel, epoch_length=1,
+                 shift_length=0.2, classifier=None, plan=None,
+                 queue_size=64, dtype=None):
+        """Initialize.
+
+        Args:
+            selector (tuple): (property, value) of the stream, see
+                stream_selector
+            fs (float): sampling frequency of the stream
+            index_channel (list): indices of the channels used
+
+        Keyword Args:
+            epoch_length (float): length of the epochs in seconds
+            shift_length (float): maximum duration of a chunk in seconds
+            classifier (tuple): (clf, mu_ft, std_ft) as returned by
+                train_classifier, or None to only compute the features
+            plan (FeaturePlan): features to extract, None for the default
+            queue_size (int): capacity of each queue, in chunks
+            dtype (numpy.dtype): type of the data in every stage,
+                BCIw.DTYPE of this process by default
+        """
+        # The stages import the toolbox again, with the default DTYPE
+        dtype = BCIw.get_dtype(dtype)
+        self.stop_event = _mp.Event()
+        # Raw chunks are never dropped, it would break the filter
+        self.raw_queue = BoundedQueue(queue_size, drop=False)
+        self.result_queue = BoundedQueue(queue_size, drop=True,
+                                         merge=merge_results)
+        self.compute_stats = _mp.Array('l', 2)
+
+        self.processes = [
+            _mp.Process(target=acquire, name='acquisition',
+                       args=(selector, list(index_channel),
+                             int(shift_length * fs), dtype, self.raw_queue,
+                             self.stop_event)),
+            _mp.Process(target=compute, name='compute',
+                       args=(fs, len(index_channel), epoch_length,
+                             classifier, plan, dtype, self.raw_queue,
+                             self.result_queue, self.stop_event,
+                             self.compute_stats))]
+        for process in self.processes:
+            process.daemon = True
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def get_results(self, timeout=None):
+        """Return the results computed since the last call, oldest first.
+
+        Waits up to "timeout" seconds if there is none yet.
+        """
+        return self.result_queue.get_all(timeout)
+
+    def is_alive(self):
+        """Return False if one of the stages ended."""
+        return all(process.is_alive() for process in self.processes)
+
+    def get_stats(self):
+        """Return the backpressure counters of every queue and stage."""
+        with self.compute_stats.get_lock():
+            processed, coalesced = list(self.compute_stats)
+        return {'raw queue': self.raw_queue.get_stats(),
+                'result queue': self.result_queue.get_stats(),
+                'compute': {'chunks': processed, 'coalesced': coalesced}}
+
+    def report(self):
+        """Return the counters as a table."""
+        stats = self.get_stats()
+        lines = ['%-14s %8s %8s %8s %8s' % ('queue', 'put', 'dropped',
+                                           'full', 'size')]
+        for name in ['raw queue', 'result queue']:
+            lines.append('%-14s %8d %8d %8d %8d' % (
+                name, stats[name]['put'], stats[name]['dropped'],
+                stats[name]['full'], stats[name]['size']))
+        lines.append('%d chunks processed, %d of them behind a newer one' % (
+            stats['compute']['chunks'], stats['compute']['coalesced']))
+        return '\n'.join(lines)
+
+    def stop(self, timeout=2.):
+        """Stop the stages and wait for them to end."""
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.raw_queue.close()
+        self.result_queue.close()
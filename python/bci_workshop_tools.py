@@ -7,18 +7,55 @@ Created on Fri May 08 15:34:59 2015
 @author: Cassani
 """
 
+import json
 import os
 import sys
 from tempfile import gettempdir
 from subprocess import call
 
+from time import perf_counter
+
 import matplotlib.pyplot as plt
 import numpy as np
+from joblib import Parallel, delayed
 from sklearn import svm
-from scipy.signal import butter, lfilter, lfilter_zi
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.model_selection import ParameterGrid, TimeSeriesSplit
+import scipy
+from scipy.fft import rfft
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+# SciPy versions the private _sosfilt below was checked against
+SOSFILT_VALIDATED = ((1, 9), (1, 17))
+
+_sosfilt = None
+if SOSFILT_VALIDATED[0] <= tuple(
+        int(v) for v in scipy.__version__.split('.')[:2]) \
+        <= SOSFILT_VALIDATED[1]:
+    try:
+        # Filters in place without validating and reshaping the arguments,
+        # which costs more than the filtering itself for small chunks. It
+        # is private, so it is only used once checked against sosfilt, see
+        # _check_sosfilt. FilterStage falls back to sosfilt otherwise.
+        from scipy.signal._sosfilt import _sosfilt
+    except ImportError:
+        pass
+
+
+# Band rejected by the notch filter (power line at 60 Hz)
+NOTCH_BAND = (55, 65)
 
+# Floating point type of the buffers, epochs and filters created by the
+# toolbox when none is given. The features and plots are computed in the
+# type of their input, so with np.float32 the data stays in single
+# precision end to end, which halves the memory used and moved.
+DTYPE = np.float64
 
-NOTCH_B, NOTCH_A = butter(4, np.array([55, 65])/(256/2), btype='bandstop')
+
+def get_dtype(dtype=None):
+    """Return "dtype", or the default DTYPE if it is None."""
+    return np.dtype(DTYPE if dtype is None else dtype)
 
 
 def plot_multichannel(data, params=None):
@@ -57,7 +94,7 @@ def plot_multichannel(data, params=None):
     plt.draw()
 
 
-def epoch(data, samples_epoch, samples_overlap=0):
+def epoch(data, samples_epoch, samples_overlap=0, view=False, dtype=None):
     """Extract epochs from a time series.
 
     Given a 2D array of the shape [n_samples, n_channels]
@@ -68,25 +105,39 @@ def epoch(data, samples_epoch, samples_overlap=0):
         samples_epoch (int): window length in samples
         samples_overlap (int): Overlap between windows in samples
 
+    Keyword Args:
+        view (bool): if True, return a read-only strided view on "data"
+            instead of copying every window. If the shift between two
+            consecutive epochs is not a whole number of samples, the epochs
+            are picked from the view and returned as a copy.
+        dtype (numpy.dtype): type of the epochs, DTYPE by default. Views
+            keep the type of "data".
+
     Returns:
         (numpy.ndarray): epoched data of shape
     """
 
     if isinstance(data, list):
-        data = np.array(data)
+        data = np.array(data, dtype=get_dtype(dtype))
 
     n_samples, n_channels = data.shape
 
+    samples_epoch = int(samples_epoch)
     samples_shift = samples_epoch - samples_overlap
 
     n_epochs =  int(np.floor((n_samples - samples_epoch) / float(samples_shift)) + 1)
 
+    if view:
+        windows, markers = _epoch_windows(data, samples_epoch, samples_shift,
+                                          n_epochs)
+        return windows if markers is None else windows[:, :, markers]
+
     # Markers indicate where the epoch starts, and the epoch contains samples_epoch rows
-    markers = np.asarray(range(0, n_epochs + 1)) * samples_shift
-    markers = markers.astype(int)
+    markers = _epoch_markers(samples_shift, n_epochs)
 
     # Divide data in epochs
-    epochs = np.zeros((samples_epoch, n_channels, n_epochs))
+    epochs = np.zeros((samples_epoch, n_channels, n_epochs),
+                      dtype=get_dtype(dtype))
 
     for i in range(0, n_epochs):
         epochs[:, :, i] = data[markers[i]:markers[i] + samples_epoch, :]
@@ -94,7 +145,286 @@ def epoch(data, samples_epoch, samples_overlap=0):
     return epochs
 
 
-def compute_feature_vector(eegdata, fs):
+def _epoch_markers(samples_shift, n_epochs):
+    """
+    Return the first sample of every epoch, the multiples of "samples_shift"
+    truncated to whole samples
+    """
+    return (np.arange(max(n_epochs, 0)) * samples_shift).astype(int)
+
+
+def _epoch_windows(data, samples_epoch, samples_shift, n_epochs):
+    """
+    Return a read-only strided view of shape [samples_epoch, n_channels,
+    n_windows] on "data", and the indices of the epochs in it.
+
+    With a whole "samples_shift", the view holds exactly the epochs and the
+    indices are None. Otherwise it holds the windows starting on every
+    sample, and the indices are the epoch markers used by epoch().
+    """
+    if samples_shift == int(samples_shift):
+        samples_shift = int(samples_shift)
+        n_windows = max(n_epochs, 0)
+        markers = None
+    else:
+        n_windows = max(data.shape[0] - samples_epoch + 1, 0)
+        markers = _epoch_markers(samples_shift, n_epochs)
+        samples_shift = 1
+
+    stride_samples, stride_channels = data.strides
+
+    windows = np.lib.stride_tricks.as_strided(
+            data, shape=(samples_epoch, data.shape[1], n_windows),
+            strides=(stride_samples, stride_channels,
+                     stride_samples * samples_shift),
+            writeable=False)
+
+    return windows, markers
+
+
+def iter_epochs(data, samples_epoch, samples_overlap=0, batch_size=100):
+    """Extract epochs from a time series lazily, by batches.
+
+    Same as epoch(data, samples_epoch, samples_overlap, view=True), but
+    yields consecutive batches of at most "batch_size" epochs, so very long
+    recordings can be processed without holding every epoch at once.
+
+    Args:
+        data (numpy.ndarray): data [n_samples, n_channels]
+        samples_epoch (int): window length in samples
+        samples_overlap (int): Overlap between windows in samples
+
+    Keyword Args:
+        batch_size (int): maximum number of epochs per batch
+
+    Yields:
+        (numpy.ndarray): epochs of shape [samples_epoch, n_channels,
+            n_epochs_in_batch], a read-only view if the shift between two
+            consecutive epochs is a whole number of samples
+    """
+    samples_epoch = int(samples_epoch)
+    samples_shift = samples_epoch - samples_overlap
+    n_epochs = int(np.floor((data.shape[0] - samples_epoch) /
+                            float(samples_shift)) + 1)
+
+    windows, markers = _epoch_windows(data, samples_epoch, samples_shift,
+                                      n_epochs)
+
+    for start in range(0, max(n_epochs, 0), batch_size):
+        if markers is None:
+            yield windows[:, :, start:start + batch_size]
+        else:
+            yield windows[:, :, markers[start:start + batch_size]]
+
+
+# Frequency bands used by default: (name, low, high, include_high).
+# A band holds the frequencies f such that low <= f < high, or
+# low <= f <= high if include_high is True.
+BANDS = (('delta', 0, 4, False),
+         ('theta', 4, 8, True),
+         ('alpha', 8, 12, True),
+         ('beta', 12, 30, False))
+
+
+class FeaturePlan():
+    """
+    Precomputed recipe to extract band power features from EEG windows.
+
+    The plan is built once from a band specification, a sampling frequency
+    and a window length. It caches the Hamming window, the FFT length and
+    the frequency bins of every band, and evaluates all the band and ratio
+    features in a single pass over the PSD. Feature names come from the
+    same plan. The features are computed in single precision for single
+    precision EEG, in double precision otherwise.
+    """
+
+    def __init__(self, fs, n_samples, bands=BANDS, ratios=(), features=None):
+        """Build the plan.
+
+        Args:
+            fs (float): sampling frequency
+            n_samples (int): window length in samples
+
+        Keyword Args:
+            bands (list): band definitions as (name, low, high) or
+                (name, low, high, include_high) tuples, see BANDS
+            ratios (list): ratio features as (name, numerator band name,
+                denominator band name) tuples
+            features (list): names of the bands and ratios returned, in
+                order. Defaults to all the bands followed by all the ratios.
+        """
+        self.fs = fs
+        self.n_samples = int(n_samples)
+        self.bands = tuple(tuple(band) for band in bands)
+        self.ratios = tuple(tuple(ratio) for ratio in ratios)
+
+        band_names = [band[0] for band in self.bands]
+        ratio_names = [ratio[0] for ratio in self.ratios]
+        if features is None:
+            features = band_names + ratio_names
+        self.features = tuple(features)
+
+        self.window = np.hamming(self.n_samples)
+        self.nfft = nextpow2(self.n_samples)
+        self.f = fs/2*np.linspace(0, 1, int(self.nfft/2))
+
+        # Index range of every band over the frequency vector
+        self.band_ranges = []
+        for band in self.bands:
+            name, low, high = band[:3]
+            include_high = band[3] if len(band) > 3 else True
+            if include_high:
+                ind, = np.where((self.f >= low) & (self.f <= high))
+            else:
+                ind, = np.where((self.f >= low) & (self.f < high))
+            if len(ind) == 0:
+                raise ValueError('Band %s contains no frequency bin' % name)
+            self.band_ranges.append((ind[0], ind[-1] + 1))
+
+        # Only the bins between k_min and k_max are used by the features
+        self.k_min = min(low for low, high in self.band_ranges)
+        self.k_max = max(high for low, high in self.band_ranges)
+
+        # Averaging matrix of the bands, [n_bands, k_max - k_min]
+        self.band_matrix = np.zeros((len(self.bands), self.k_max - self.k_min))
+        for i_band, (low, high) in enumerate(self.band_ranges):
+            self.band_matrix[i_band, low - self.k_min:high - self.k_min] = \
+                1. / (high - low)
+
+        # Features as indices into the band powers
+        ratio_bands = dict((ratio[0], ratio[1:]) for ratio in self.ratios)
+        self._numerators = []
+        self._ratio_rows = []
+        self._denominators = []
+        for i_feat, name in enumerate(self.features):
+            if name in ratio_bands:
+                numerator, denominator = ratio_bands[name]
+                self._numerators.append(band_names.index(numerator))
+                self._ratio_rows.append(i_feat)
+                self._denominators.append(band_names.index(denominator))
+            else:
+                self._numerators.append(band_names.index(name))
+
+        # Window and band matrix in the type of the data, by type
+        self._arrays = {}
+
+    def _get_arrays(self, dtype):
+        """Return the window and the band matrix as "dtype"."""
+        if dtype not in self._arrays:
+            self._arrays[dtype] = (self.window.astype(dtype),
+                                   self.band_matrix.astype(dtype))
+        return self._arrays[dtype]
+
+    @property
+    def n_features_per_channel(self):
+        return len(self.features)
+
+    def compute_psd(self, eegdata):
+        """Compute the PSD of the bins used by the features.
+
+        Args:
+            eegdata (numpy.ndarray): array of dimension [number of samples,
+                number of channels] or [number of samples, number of
+                channels, number of epochs]
+
+        Returns:
+            (numpy.ndarray): PSD of shape [k_max - k_min, ...]
+        """
+        dtype = np.result_type(eegdata.dtype, np.float32)
+        w = self._get_arrays(dtype)[0].reshape(
+                (-1,) + (1,) * (eegdata.ndim - 1))
+
+        # Remove offset and apply Hamming window
+        dataWinCenteredHam = (eegdata - np.mean(eegdata, axis=0,
+                                                dtype=dtype)) * w
+
+        # scipy's FFT keeps single precision data in single precision
+        Y = rfft(dataWinCenteredHam, n=self.nfft, axis=0)
+        return 2*np.abs(Y[self.k_min:self.k_max])/self.n_samples
+
+    def evaluate(self, PSD):
+        """Compute the features from the PSD returned by compute_psd.
+
+        Returns:
+            (numpy.ndarray): log10 features of shape [n_features, ...]
+        """
+        band_matrix = self._get_arrays(PSD.dtype)[1]
+        # Same as tensordot over the first axis, without its overhead
+        band_powers = np.dot(band_matrix, PSD.reshape(PSD.shape[0], -1))
+        band_powers = band_powers.reshape((-1,) + PSD.shape[1:])
+        features = band_powers[self._numerators]
+        if self._ratio_rows:
+            features[self._ratio_rows] /= band_powers[self._denominators]
+
+        return np.log10(features)
+
+    def compute_feature_vector(self, eegdata):
+        """Extract the features of a window of shape [n_samples, n_channels].
+
+        Returns:
+            (numpy.ndarray): features, ordered by feature then by channel
+        """
+        return self.evaluate(self.compute_psd(eegdata)).ravel()
+
+    def compute_feature_matrix(self, epochs, batch_size=None):
+        """Extract the features of epochs of shape [n_samples, n_channels,
+        n_epochs].
+
+        Keyword Args:
+            batch_size (int): if given, the epochs are transformed by
+                batches of this size to bound the memory used
+
+        Returns:
+            (numpy.ndarray): feature matrix of shape [number of epochs,
+                number of features]
+        """
+        n_epochs = epochs.shape[2]
+        if batch_size is None:
+            batch_size = max(n_epochs, 1)
+
+        feature_matrix = np.zeros(
+                (n_epochs, self.n_features_per_channel * epochs.shape[1]),
+                dtype=np.result_type(epochs.dtype, np.float32))
+        for start in range(0, n_epochs, batch_size):
+            batch = epochs[:, :, start:start + batch_size]
+            features = self.evaluate(self.compute_psd(batch))
+            feature_matrix[start:start + batch.shape[2], :] = \
+                features.reshape(-1, batch.shape[2]).T
+
+        return feature_matrix
+
+    def get_feature_names(self, ch_names):
+        """Generate the name of the features.
+
+        Args:
+            ch_names (list): electrode names
+
+        Returns:
+            (list): feature names, in the order of the features
+        """
+        return [feature + '-' + ch for feature in self.features
+                for ch in ch_names]
+
+
+_feature_plans = {}
+
+
+def get_feature_plan(fs, n_samples, bands=BANDS, ratios=(), features=None):
+    """
+    Return the FeaturePlan for these parameters, building it only the
+    first time
+    """
+    key = (fs, int(n_samples), tuple(tuple(band) for band in bands),
+           tuple(tuple(ratio) for ratio in ratios),
+           None if features is None else tuple(features))
+    if key not in _feature_plans:
+        _feature_plans[key] = FeaturePlan(fs, n_samples, bands, ratios,
+                                          features)
+
+    return _feature_plans[key]
+
+
+def compute_feature_vector(eegdata, fs, plan=None):
     """Extract the features from the EEG.
 
     Args:
@@ -102,44 +432,18 @@ def compute_feature_vector(eegdata, fs):
                 number of channels]
         fs (float): sampling frequency of eegdata
 
+    Keyword Args:
+        plan (FeaturePlan): features to extract. Defaults to the band
+            powers of BANDS.
+
     Returns:
         (numpy.ndarray): feature matrix of shape [number of feature points,
             number of different features]
     """
-    # 1. Compute the PSD
-    winSampleLength, nbCh = eegdata.shape
+    if plan is None:
+        plan = get_feature_plan(fs, eegdata.shape[0])
 
-    # Apply Hamming window
-    w = np.hamming(winSampleLength)
-    dataWinCentered = eegdata - np.mean(eegdata, axis=0)  # Remove offset
-    dataWinCenteredHam = (dataWinCentered.T*w).T
-
-    NFFT = nextpow2(winSampleLength)
-    Y = np.fft.fft(dataWinCenteredHam, n=NFFT, axis=0)/winSampleLength
-    PSD = 2*np.abs(Y[0:int(NFFT/2), :])
-    f = fs/2*np.linspace(0, 1, int(NFFT/2))
-
-    # SPECTRAL FEATURES
-    # Average of band powers
-    # Delta <4
-    ind_delta, = np.where(f < 4)
-    meanDelta = np.mean(PSD[ind_delta, :], axis=0)
-    # Theta 4-8
-    ind_theta, = np.where((f >= 4) & (f <= 8))
-    meanTheta = np.mean(PSD[ind_theta, :], axis=0)
-    # Alpha 8-12
-    ind_alpha, = np.where((f >= 8) & (f <= 12))
-    meanAlpha = np.mean(PSD[ind_alpha, :], axis=0)
-    # Beta 12-30
-    ind_beta, = np.where((f >= 12) & (f < 30))
-    meanBeta = np.mean(PSD[ind_beta, :], axis=0)
-
-    feature_vector = np.concatenate((meanDelta, meanTheta, meanAlpha,
-                                     meanBeta), axis=0)
-
-    feature_vector = np.log10(feature_vector)
-
-    return feature_vector
+    return plan.compute_feature_vector(eegdata)
 
 
 def nextpow2(i):
@@ -152,24 +456,240 @@ def nextpow2(i):
     return n
 
 
-def compute_feature_matrix(epochs, fs):
+def compute_feature_matrix(epochs, fs, batch_size=None, plan=None):
+    """Extract the features from all the EEG epochs at once.
+
+    Equivalent to calling compute_feature_vector on each epoch, but all the
+    epochs are transformed with a single real FFT.
+
+    Args:
+        epochs (numpy.ndarray): array of dimension [number of samples,
+                number of channels, number of epochs]
+        fs (float): sampling frequency of the epochs
+
+    Keyword Args:
+        batch_size (int): if given, the epochs are transformed by batches of
+            this size to bound the memory used for long recordings
+        plan (FeaturePlan): features to extract. Defaults to the band
+            powers of BANDS.
+
+    Returns:
+        (numpy.ndarray): feature matrix of shape [number of epochs,
+            number of features]
+    """
+    if plan is None:
+        plan = get_feature_plan(fs, epochs.shape[0])
+
+    return plan.compute_feature_matrix(epochs, batch_size)
+
+
+class SlidingBandPower():
+    """
+    Streaming version of compute_feature_vector for overlapping windows.
+
+    The newest "n_samples" samples are kept in a RingBuffer, and the DFT
+    bins used by the bands are computed from it with a single matrix
+    product. The offset removal, the Hamming window and the DFT of those
+    bins are folded into one precomputed matrix, whose rows hold the real
+    and imaginary parts of every bin. Only the few bins covered by the
+    bands are computed, so an update costs less than the full FFT path,
+    whatever the number of new samples.
+    """
+
+    def __init__(self, n_samples, n_channels, fs, plan=None, dtype=None):
+        """Initialize the engine with an all-zero window.
+
+        Args:
+            n_samples (int): window length in samples
+            n_channels (int): number of channels
+            fs (float): sampling frequency
+
+        Keyword Args:
+            plan (FeaturePlan): features to extract. Defaults to the band
+                powers of BANDS.
+            dtype (numpy.dtype): type of the window, of the matrix and of
+                the features, DTYPE by default
+        """
+        self.n_samples = int(n_samples)
+        self.n_channels = int(n_channels)
+        self.fs = fs
+        self.dtype = get_dtype(dtype)
+        if plan is None:
+            plan = get_feature_plan(fs, n_samples)
+        if plan.n_samples != self.n_samples:
+            raise ValueError('The plan is for windows of %d samples, not %d'
+                             % (plan.n_samples, self.n_samples))
+        self.plan = plan
+
+        # Windowed DFT of the bins k_min to k_max, minus the DFT of the
+        # mean of the window
+        N = self.n_samples
+        k = np.arange(plan.k_min, plan.k_max)
+        dft = np.exp(-2j * np.pi * np.outer(k, np.arange(N)) / plan.nfft) \
+            * plan.window
+        dft -= np.sum(dft, axis=1, keepdims=True) / N
+        self._n_bins = len(k)
+        self._matrix = np.ascontiguousarray(
+                np.vstack((dft.real, dft.imag)), dtype=self.dtype)
+
+        self._window = RingBuffer(N, self.n_channels, dtype=self.dtype)
+
+    def update(self, new_data):
+        """Slide the window over "new_data" and return the new features.
+
+        Args:
+            new_data (numpy.ndarray): array of shape [n_new, n_channels]
+
+        Returns:
+            (numpy.ndarray): same feature vector as compute_feature_vector
+                on the newest "n_samples" samples
+        """
+        self._window.update(new_data)
+        return self.get_feature_vector()
+
+    def get_feature_vector(self):
+        """Return the features of the current window."""
+        K = self._n_bins
+        Y = np.dot(self._matrix, self._window.get_data())
+        PSD = np.hypot(Y[:K], Y[K:])
+        PSD *= 2. / self.n_samples
+
+        return self.plan.evaluate(PSD).ravel()
+
+
+# Classifiers available to train_classifier, and the hyperparameters
+# searched for each of them
+CLASSIFIERS = {'SVM': svm.SVC,
+               'LDA': LinearDiscriminantAnalysis,
+               'logistic': LogisticRegression}
+CLASSIFIER_GRIDS = {
+    'SVM': [{'kernel': ['linear'], 'C': [0.01, 0.1, 1, 10, 100]},
+            {'kernel': ['rbf'], 'C': [0.1, 1, 10, 100],
+             'gamma': ['scale', 0.001, 0.01, 0.1, 1]}],
+    'LDA': [{'solver': ['svd']},
+            {'solver': ['lsqr'], 'shrinkage': ['auto', 0.1, 0.5]}],
+    'logistic': [{'C': [0.01, 0.1, 1, 10, 100]}]}
+
+
+def time_series_splits(n_samples_0, n_samples_1, n_splits=5, gap=0):
+    """Cross-validation splits that respect the order of the epochs.
+
+    Each class is recorded in one block, so the epochs of each class are
+    split forward in time on their own (see sklearn's TimeSeriesSplit):
+    every fold tests on epochs recorded after all the training epochs of
+    the same class, and both classes are in every training and test set.
+
+    Args:
+        n_samples_0 (int): number of examples of class 0, first in the data
+        n_samples_1 (int): number of examples of class 1, after class 0
+
+    Keyword Args:
+        n_splits (int): number of folds
+        gap (int): number of epochs left out between the training and the
+            test epochs, e.g. the number of epochs that overlap with each
+            epoch
+
+    Returns:
+        (list): (train indices, test indices) of every fold
     """
-    Call compute_feature_vector for each EEG epoch
+    cv = TimeSeriesSplit(n_splits=n_splits, gap=gap)
+    splits = []
+    for (train_0, test_0), (train_1, test_1) in zip(
+            cv.split(np.zeros(n_samples_0)), cv.split(np.zeros(n_samples_1))):
+        splits.append((np.concatenate((train_0, n_samples_0 + train_1)),
+                       np.concatenate((test_0, n_samples_0 + test_1))))
+    return splits
+
+
+def _evaluate_candidate(algorithm, params, X, y, train, test):
+    """Fit one candidate on one fold and return its score and timings."""
+    clf = CLASSIFIERS[algorithm](**params)
+    start = perf_counter()
+    clf.fit(X[train], y[train])
+    fit_time = perf_counter() - start
+    score = clf.score(X[test], y[test])
+    return score, fit_time, perf_counter() - start - fit_time
+
+
+def select_classifier(X, y, splits, algorithm='all', search='grid',
+                      n_iter=20, n_jobs=-1, random_state=None):
+    """Select the classifier and hyperparameters by cross-validation.
+
+    The fits of all the candidates and folds run in parallel. The feature
+    matrix is memory-mapped by the workers instead of being sent to each
+    fit.
+
+    Args:
+        X (numpy.ndarray): normalized features, [n_samples, n_features]
+        y (numpy.ndarray): labels, [n_samples]
+        splits (list): (train indices, test indices) of every fold, see
+            time_series_splits
+
+    Keyword Args:
+        algorithm (str): type of classifier to consider, see CLASSIFIERS,
+            or 'all'
+        search (str): 'grid' to try every candidate of CLASSIFIER_GRIDS,
+            'random' to try "n_iter" of them drawn at random
+        n_jobs (int): number of parallel workers, -1 for all the cores
+
+    Returns:
+        (sklearn object): best classifier, fitted on all the data
+        (float): its mean cross-validation score
+        (list): one dict per candidate, best first, with the 'algorithm',
+            its 'params', the mean and standard deviation of its scores,
+            and its total fit and scoring times in seconds
     """
-    n_epochs = epochs.shape[2]
+    algorithms = sorted(CLASSIFIERS) if algorithm == 'all' else [algorithm]
+    candidates = [(name, params) for name in algorithms
+                  for params in ParameterGrid(CLASSIFIER_GRIDS[name])]
+    if search == 'random' and n_iter < len(candidates):
+        rng = np.random.RandomState(random_state)
+        candidates = [candidates[i] for i in sorted(
+                rng.choice(len(candidates), n_iter, replace=False))]
+    elif search not in ['grid', 'random']:
+        raise ValueError('Unknown search %s' % search)
+
+    # max_nbytes=0: memory-map every array passed to the workers
+    results = Parallel(n_jobs=n_jobs, max_nbytes=0)(
+            delayed(_evaluate_candidate)(name, params, X, y, train, test)
+            for name, params in candidates for train, test in splits)
+    results = np.array(results).reshape(len(candidates), len(splits), 3)
+
+    report = []
+    for (name, params), result in zip(candidates, results):
+        report.append({'algorithm': name, 'params': params,
+                       'mean score': float(np.mean(result[:, 0])),
+                       'std score': float(np.std(result[:, 0])),
+                       'fit time': float(np.sum(result[:, 1])),
+                       'score time': float(np.sum(result[:, 2]))})
+    # Best score first, the fastest to fit among equals
+    report.sort(key=lambda c: (-c['mean score'], c['fit time']))
+
+    best = report[0]
+    clf = CLASSIFIERS[best['algorithm']](**best['params'])
+    clf.fit(X, y)
 
-    for i_epoch in range(n_epochs):
-        if i_epoch == 0:
-            feat = compute_feature_vector(epochs[:, :, i_epoch], fs).T
-            feature_matrix = np.zeros((n_epochs, feat.shape[0])) # Initialize feature_matrix
+    return clf, best['mean score'], report
 
-        feature_matrix[i_epoch, :] = compute_feature_vector(
-                epochs[:, :, i_epoch], fs).T
 
-    return feature_matrix
+def format_selection_report(report):
+    """Return the report of select_classifier as a table."""
+    lines = ['%-10s %-45s %7s %7s %9s %10s' % (
+             'algorithm', 'parameters', 'score', 'std', 'fit (ms)',
+             'score (ms)')]
+    for candidate in report:
+        params = ', '.join('%s=%s' % (key, candidate['params'][key])
+                           for key in sorted(candidate['params']))
+        lines.append('%-10s %-45s %7.3f %7.3f %9.1f %10.1f' % (
+            candidate['algorithm'], params, candidate['mean score'],
+            candidate['std score'], candidate['fit time'] * 1e3,
+            candidate['score time'] * 1e3))
+    return '\n'.join(lines)
 
 
-def train_classifier(feature_matrix_0, feature_matrix_1, algorithm='SVM'):
+def train_classifier(feature_matrix_0, feature_matrix_1, algorithm='SVM',
+                     search=None, n_splits=5, gap=0, n_iter=20, n_jobs=-1,
+                     return_report=False):
     """Train a binary classifier.
 
     Train a binary classifier. First perform Z-score normalization, then
@@ -177,23 +697,37 @@ def train_classifier(feature_matrix_0, feature_matrix_1, algorithm='SVM'):
 
     Args:
         feature_matrix_0 (numpy.ndarray): array of shape (n_samples,
-            n_features) with examples for Class 0
+            n_features) with examples for Class 0, in recording order
         feature_matrix_0 (numpy.ndarray): array of shape (n_samples,
-            n_features) with examples for Class 1
-        alg (str): Type of classifer to use. Currently only SVM is
-            supported.
+            n_features) with examples for Class 1, in recording order
+        alg (str): Type of classifer to use, see CLASSIFIERS. 'all'
+            searches all of them.
+
+    Keyword Args:
+        search (str): None to fit the classifier with its default
+            hyperparameters, 'grid' or 'random' to select them by
+            cross-validation, see select_classifier
+        n_splits (int): number of cross-validation folds
+        gap (int): number of epochs overlapping with each epoch, left out
+            between training and test epochs
+        n_iter (int): number of candidates of the random search
+        n_jobs (int): number of parallel workers, -1 for all the cores
+        return_report (bool): also return the report of select_classifier
 
     Returns:
         (sklearn object): trained classifier (scikit object)
         (numpy.ndarray): normalization mean
         (numpy.ndarray): normalization standard deviation
+        (float): training score, or mean cross-validation score of the
+            selected classifier with "search"
+        (list): report of the candidates, only with "return_report"
     """
     # Create vector Y (class labels)
     class0 = np.zeros((feature_matrix_0.shape[0], 1))
     class1 = np.ones((feature_matrix_1.shape[0], 1))
 
     # Concatenate feature matrices and their respective labels
-    y = np.concatenate((class0, class1), axis=0)
+    y = np.concatenate((class0, class1), axis=0).ravel()
     features_all = np.concatenate((feature_matrix_0, feature_matrix_1),
                                   axis=0)
 
@@ -203,14 +737,23 @@ def train_classifier(feature_matrix_0, feature_matrix_1, algorithm='SVM'):
 
     X = (features_all - mu_ft) / std_ft
 
-    # Train SVM using default parameters
-    clf = svm.SVC()
-    clf.fit(X, y)
-    score = clf.score(X, y.ravel())
+    if search is None:
+        # Train using default parameters
+        clf = CLASSIFIERS['SVM' if algorithm == 'all' else algorithm]()
+        clf.fit(X, y)
+        score = clf.score(X, y)
+        report = []
+    else:
+        splits = time_series_splits(feature_matrix_0.shape[0],
+                                    feature_matrix_1.shape[0], n_splits, gap)
+        clf, score, report = select_classifier(
+                X, y, splits, algorithm, search, n_iter, n_jobs)
 
     # Visualize decision boundary
 #    plot_classifier_training(clf, X, y, features_to_plot=[0, 1])
 
+    if return_report:
+        return clf, mu_ft, std_ft, score, report
     return clf, mu_ft, std_ft, score
 
 
@@ -235,6 +778,203 @@ def test_classifier(clf, feature_vector, mu_ft, std_ft):
     return y_hat
 
 
+class CompiledClassifier():
+    """
+    Trained classifier exported to a few NumPy arrays, for fast decisions.
+
+    test_classifier normalizes a copy of the features and goes through the
+    input validation of sklearn on every call, which takes much longer than
+    the decision itself for a single epoch. Here the z-score normalization
+    is folded into the parameters of the model once, so a decision is a
+    couple of matrix products on the raw feature vector.
+
+    Supports binary SVC with a linear or RBF kernel and the linear models
+    with coef_ and intercept_ (LinearDiscriminantAnalysis,
+    LogisticRegression, SGDClassifier, ...). Gives the same decisions as
+    test_classifier, up to rounding for points on the boundary.
+    """
+
+    def __init__(self, clf, mu_ft, std_ft):
+        """Export a trained classifier.
+
+        Args:
+            clf (sklearn object): trained binary classifier
+            mu_ft (numpy.ndarray): normalization mean
+            std_ft (numpy.ndarray): normalization standard deviation
+        """
+        if len(clf.classes_) != 2:
+            raise ValueError('Only binary classifiers can be compiled')
+        self.classes = np.array(clf.classes_)
+        mu_ft = np.ravel(mu_ft).astype(float)
+        std_ft = np.ravel(std_ft).astype(float)
+
+        kernel = getattr(clf, 'kernel', 'linear')
+        if kernel == 'linear':
+            # w.((x - mu) / std) + b = (w / std).x + b - (w / std).mu
+            coef = np.ravel(clf.coef_) / std_ft
+            self.kernel = 'linear'
+            self.coef = coef
+            self.intercept = float(clf.intercept_[0]) - np.dot(coef, mu_ft)
+        elif kernel == 'rbf':
+            # gamma |(x - mu) / std - sv|^2 = |x * scale - center|^2, with
+            # scale = sqrt(gamma) / std and center = (sv + mu / std) *
+            # sqrt(gamma)
+            root_gamma = np.sqrt(clf._gamma)
+            self.kernel = 'rbf'
+            self.scale = root_gamma / std_ft
+            centers = (np.asarray(clf.support_vectors_) + mu_ft / std_ft) \
+                * root_gamma
+            self.centers_t = np.ascontiguousarray(centers.T)
+            self.centers_sq = np.sum(centers ** 2, axis=1)
+            self.dual_coef = np.ravel(clf.dual_coef_).astype(float)
+            self.intercept = float(clf.intercept_[0])
+        else:
+            raise ValueError('Cannot compile a %s kernel' % kernel)
+
+    def decision_function(self, feature_vector):
+        """Signed distance of epochs of shape (n_samples, n_features) to
+        the decision boundary, positive for the second class."""
+        if self.kernel == 'linear':
+            return np.dot(feature_vector, self.coef) + self.intercept
+
+        x = feature_vector * self.scale
+        # Squared distances to the support vectors, expanded so that they
+        # take one matrix product
+        dist = np.dot(x, self.centers_t)
+        dist *= -2
+        dist += self.centers_sq
+        dist += np.sum(x * x, axis=1)[:, np.newaxis]
+        np.negative(dist, out=dist)
+        np.exp(dist, out=dist)
+        return np.dot(dist, self.dual_coef) + self.intercept
+
+    def predict(self, feature_vector):
+        """Classify epochs of shape (n_samples, n_features).
+
+        Returns:
+            (numpy.ndarray): decision of the classifier on the data points,
+                as test_classifier
+        """
+        return self.classes[
+            (self.decision_function(feature_vector) > 0).astype(int)]
+
+
+class OnlineClassifier():
+    """
+    Linear classifier that keeps learning during a session.
+
+    The mean and variance of the features are running estimates updated
+    with Welford's algorithm, optionally forgetting old epochs, and the
+    classifier is a linear model updated with partial_fit. Each update
+    costs O(number of features), so the classifier can follow the drift of
+    the electrodes during long sessions without pausing to retrain.
+    """
+
+    def __init__(self, halflife=None, **sgd_params):
+        """Initialize.
+
+        Keyword Args:
+            halflife (float): number of updates after which the weight of an
+                epoch in the normalization is halved. None to weight all
+                the epochs equally.
+            sgd_params: parameters of sklearn's SGDClassifier. Defaults to
+                a linear SVM with a constant learning rate, which does not
+                freeze after many updates.
+        """
+        self.halflife = halflife
+        self.decay = 1. if halflife is None else 0.5 ** (1. / halflife)
+        self.sgd_params = dict({'loss': 'hinge', 'learning_rate': 'constant',
+                                'eta0': 0.01}, **sgd_params)
+        self.clf = SGDClassifier(**self.sgd_params)
+        self.classes = np.array([0., 1.])
+
+        # Running normalization: total weight, mean and weighted sum of
+        # squared deviations of every feature
+        self.weight = 0.
+        self.mean = None
+        self.m2 = None
+
+    @property
+    def std(self):
+        """Running standard deviation of the features."""
+        std = np.sqrt(self.m2 / self.weight)
+        std[std == 0] = 1
+        return std
+
+    def normalize(self, feature_vector):
+        """Z-score features with the running mean and deviation."""
+        return (feature_vector - self.mean) / self.std
+
+    def fit(self, feature_matrix_0, feature_matrix_1, n_passes=5,
+            random_state=None):
+        """Initialize the normalization and the model from calibration data.
+
+        Args:
+            feature_matrix_0 (numpy.ndarray): array of shape (n_samples,
+                n_features) with examples for Class 0
+            feature_matrix_1 (numpy.ndarray): array of shape (n_samples,
+                n_features) with examples for Class 1
+
+        Keyword Args:
+            n_passes (int): number of passes over the shuffled data
+
+        Returns:
+            (float): training score
+        """
+        X = np.concatenate((feature_matrix_0, feature_matrix_1), axis=0)
+        y = np.concatenate((np.zeros(feature_matrix_0.shape[0]),
+                            np.ones(feature_matrix_1.shape[0])))
+
+        self.weight = float(X.shape[0])
+        self.mean = np.mean(X, axis=0)
+        self.m2 = np.var(X, axis=0) * self.weight
+
+        X = self.normalize(X)
+        rng = np.random.RandomState(random_state)
+        self.clf = SGDClassifier(**self.sgd_params)
+        for i in range(n_passes):
+            order = rng.permutation(len(y))
+            self.clf.partial_fit(X[order], y[order], classes=self.classes)
+
+        return self.clf.score(X, y)
+
+    def update_normalization(self, feature_vector):
+        """Add one epoch, labeled or not, to the running normalization."""
+        x = np.ravel(feature_vector)
+        if self.mean is None:
+            self.mean = np.zeros_like(x, dtype=float)
+            self.m2 = np.zeros_like(x, dtype=float)
+
+        # Weighted Welford update, the past weighing "decay" times less
+        self.weight = self.weight * self.decay + 1.
+        self.m2 *= self.decay
+        delta = x - self.mean
+        self.mean += delta / self.weight
+        self.m2 += delta * (x - self.mean)
+
+    def partial_fit(self, feature_vector, label):
+        """Learn from one labeled epoch.
+
+        The epoch is added to the normalization first.
+
+        Args:
+            feature_vector (numpy.ndarray): features of the epoch
+            label (int): its class, 0 or 1
+        """
+        self.update_normalization(feature_vector)
+        x = self.normalize(np.ravel(feature_vector))
+        self.clf.partial_fit(x.reshape(1, -1), [float(label)],
+                             classes=self.classes)
+
+    def predict(self, feature_vector):
+        """Classify epochs of shape (n_samples, n_features)."""
+        return self.clf.predict(self.normalize(feature_vector))
+
+    def decision_function(self, feature_vector):
+        """Signed distance of epochs to the decision boundary."""
+        return self.clf.decision_function(self.normalize(feature_vector))
+
+
 def beep(waveform=(79, 45, 32, 50, 99, 113, 126, 127)):
     """Play a beep sound.
 
@@ -259,41 +999,168 @@ def beep(waveform=(79, 45, 32, 50, 99, 113, 126, 127)):
                     shell=1)
 
 
-def get_feature_names(ch_names):
+def get_feature_names(ch_names, plan):
     """Generate the name of the features.
 
     Args:
         ch_names (list): electrode names
+        plan (FeaturePlan): plan the features come from
 
     Returns:
         (list): feature names
     """
-    bands = ['delta', 'theta', 'alpha', 'beta']
+    return plan.get_feature_names(ch_names)
 
-    feat_names = []
-    for band in bands:
-        for ch in range(len(ch_names)):
-            feat_names.append(band + '-' + ch_names[ch])
 
-    return feat_names
+_filter_designs = {}
+_sosfilt_checks = {}
 
 
-def update_buffer(data_buffer, new_data, notch=False, filter_state=None):
+def _check_sosfilt(dtype):
+    """
+    Return True if scipy's private _sosfilt filters data of type "dtype"
+    in place and updates the state exactly as the public sosfilt. The
+    check runs once per type. _sosfilt is only imported for the SciPy
+    versions in SOSFILT_VALIDATED.
+    """
+    if _sosfilt is None:
+        return False
+    if dtype not in _sosfilt_checks:
+        rng = np.random.RandomState(0)
+        sos = butter(4, [0.2, 0.4], btype='bandpass', output='sos')
+        sos = sos.astype(dtype)
+        data = rng.randn(2, 32).astype(dtype)
+        zi = rng.randn(2, sos.shape[0], 2).astype(dtype)
+
+        expected, expected_zi = sosfilt(sos, data, axis=-1,
+                                        zi=zi.transpose(1, 0, 2))
+        try:
+            _sosfilt(sos, data, zi)
+            tolerance = 10 * np.finfo(dtype).eps
+            works = (np.allclose(data, expected, rtol=tolerance,
+                                 atol=tolerance) and
+                     np.allclose(zi, expected_zi.transpose(1, 0, 2),
+                                 rtol=tolerance, atol=tolerance))
+        except Exception:
+            works = False
+        _sosfilt_checks[dtype] = works
+
+    return _sosfilt_checks[dtype]
+
+
+def design_filter(btype, fs, band, order=4):
+    """Design a Butterworth filter as second-order sections.
+
+    Designs are cached by (btype, fs, band, order), so every buffer and
+    viewer filtering a stream at the same rate shares them.
+
+    Args:
+        btype (str): 'notch', 'bandpass', 'highpass' or 'lowpass'
+        fs (float): sampling frequency, e.g. info.nominal_srate()
+        band (float or tuple): cutoff frequency, or (low, high) for notch
+            and bandpass filters, in Hz
+
+    Keyword Args:
+        order (int): order of the Butterworth filter
+
+    Returns:
+        (numpy.ndarray): read-only sections of shape [n_sections, 6]
+    """
+    band = tuple(float(f) for f in np.atleast_1d(band))
+    key = (btype, float(fs), band, order)
+    if key not in _filter_designs:
+        if max(band) >= fs / 2.:
+            raise ValueError('Cutoff frequency %g Hz is above the Nyquist '
+                             'frequency of a stream sampled at %g Hz'
+                             % (max(band), fs))
+        sos = butter(order, np.array(band) / (fs / 2.),
+                     btype='bandstop' if btype == 'notch' else btype,
+                     output='sos')
+        sos.flags.writeable = False
+        _filter_designs[key] = sos
+
+    return _filter_designs[key]
+
+
+class FilterStage():
+    """
+    Causal filter applied chunk by chunk to a multichannel signal.
+
+    The filters are cascaded into a single set of second-order sections
+    and the state of every channel is kept between chunks, so a signal
+    filtered in chunks is the same as the signal filtered at once.
+    """
+
+    def __init__(self, n_channels, fs, filters=(('notch', NOTCH_BAND, 4),),
+                 dtype=None):
+        """Initialize.
+
+        Args:
+            n_channels (int): number of channels
+            fs (float): sampling frequency
+
+        Keyword Args:
+            filters (list): (btype, band, order) of the filters to apply,
+                see design_filter
+            dtype (numpy.dtype): type of the sections, of the state and of
+                the filtered data, DTYPE by default
+        """
+        self.n_channels = int(n_channels)
+        self.fs = fs
+        self.filters = tuple(filters)
+        self.dtype = get_dtype(dtype)
+        self.sos = np.vstack([design_filter(btype, fs, band, order)
+                              for btype, band, order in self.filters]
+                             ).astype(self.dtype)
+        # State of the sections, [n_channels, n_sections, 2]
+        self.zi = None
+        self._in_place = _check_sosfilt(self.dtype)
+
+    def reset(self):
+        """Forget the past of the signal."""
+        self.zi = None
+
+    def filter(self, data):
+        """Filter a chunk of shape [n_samples, n_channels]."""
+        if self.zi is None:
+            # Steady state for a unit step, as lfilter_zi
+            self.zi = np.tile(sosfilt_zi(self.sos),
+                              (self.n_channels, 1, 1)).astype(self.dtype)
+
+        # One contiguous row per channel, filtered in place
+        data = np.array(np.asarray(data, dtype=self.dtype).T, order='C')
+        if self._in_place:
+            _sosfilt(self.sos, data, self.zi)
+        else:
+            data, zi = sosfilt(self.sos, data, axis=-1,
+                               zi=self.zi.transpose(1, 0, 2))
+            self.zi = np.ascontiguousarray(zi.transpose(1, 0, 2))
+
+        return data.T
+
+
+def update_buffer(data_buffer, new_data, notch=False, filter_state=None,
+                  fs=256.):
     """
     Concatenates "new_data" into "data_buffer", and returns an array with
     the same size as "data_buffer"
+
+    If "notch" is True, "new_data" is notch filtered first. Pass the
+    returned "filter_state" to the next call to filter continuously. The
+    buffer keeps its type.
     """
     if new_data.ndim == 1:
         new_data = new_data.reshape(-1, data_buffer.shape[1])
 
     if notch:
         if filter_state is None:
-            filter_state = np.tile(lfilter_zi(NOTCH_B, NOTCH_A),
-                                   (data_buffer.shape[1], 1)).T
-        new_data, filter_state = lfilter(NOTCH_B, NOTCH_A, new_data, axis=0,
-                                         zi=filter_state)
+            filter_state = FilterStage(data_buffer.shape[1], fs,
+                                       dtype=data_buffer.dtype)
+        new_data = filter_state.filter(new_data)
 
-    new_buffer = np.concatenate((data_buffer, new_data), axis=0)
+    new_buffer = np.concatenate(
+            (data_buffer, new_data.astype(data_buffer.dtype, copy=False)),
+            axis=0)
     new_buffer = new_buffer[new_data.shape[0]:, :]
 
     return new_buffer, filter_state
@@ -309,13 +1176,209 @@ def get_last_data(data_buffer, newest_samples):
     return new_buffer
 
 
+class RingBuffer():
+    """
+    Fixed-size buffer holding the newest samples of a multichannel signal.
+
+    The storage is allocated once with twice the buffer length and every
+    sample is written at two positions, one buffer length apart. Appending
+    therefore only costs the new samples, and the newest samples always
+    form a contiguous block that is returned as a view, without copying.
+    """
+
+    def __init__(self, n_samples, n_channels, notch=False, fs=256.,
+                 dtype=None):
+        """Initialize the buffer with zeros.
+
+        Args:
+            n_samples (int): number of samples kept in the buffer
+            n_channels (int): number of channels
+
+        Keyword Args:
+            notch (bool): if True, new data is notch filtered before being
+                stored, keeping the filter state between updates
+            fs (float): sampling frequency, used to design the filter
+            dtype (numpy.dtype): type of the samples stored, DTYPE by
+                default
+        """
+        self.n_samples = int(n_samples)
+        self.n_channels = int(n_channels)
+        self.notch = notch
+        self.dtype = get_dtype(dtype)
+        self.filter_stage = FilterStage(self.n_channels, fs,
+                                        dtype=self.dtype) if notch else None
+
+        self._data = np.zeros((2 * self.n_samples, self.n_channels),
+                              dtype=self.dtype)
+        self._pos = 0
+
+    @property
+    def shape(self):
+        return (self.n_samples, self.n_channels)
+
+    def update(self, new_data):
+        """Append "new_data" to the buffer, dropping the oldest samples.
+
+        Args:
+            new_data (numpy.ndarray): array of shape [n_new, n_channels], or
+                a flat array holding whole rows
+        """
+        new_data = np.asarray(new_data)
+        if new_data.ndim == 1:
+            new_data = new_data.reshape(-1, self.n_channels)
+
+        if self.notch:
+            new_data = self.filter_stage.filter(new_data)
+
+        if new_data.shape[0] > self.n_samples:
+            new_data = new_data[-self.n_samples:, :]
+        n_new = new_data.shape[0]
+
+        # Copy the part that fits before the end of the first half, then
+        # wrap around for the rest. Each part is mirrored in the second half.
+        n_first = min(n_new, self.n_samples - self._pos)
+        n_second = n_new - n_first
+        start = self._pos
+        self._data[start:start + n_first] = new_data[:n_first]
+        self._data[start + self.n_samples:
+                   start + self.n_samples + n_first] = new_data[:n_first]
+        if n_second:
+            self._data[:n_second] = new_data[n_first:]
+            self._data[self.n_samples:self.n_samples + n_second] = \
+                new_data[n_first:]
+
+        self._pos = (self._pos + n_new) % self.n_samples
+
+    def get_last_data(self, newest_samples):
+        """
+        Return a view on the "newest_samples" rows of the buffer, oldest
+        first
+        """
+        newest_samples = int(newest_samples)
+        if not 0 <= newest_samples <= self.n_samples:
+            raise ValueError('Cannot return %d samples from a buffer of %d '
+                             'samples' % (newest_samples, self.n_samples))
+        end = self._pos + self.n_samples
+        return self._data[end - newest_samples:end, :]
+
+    def get_data(self):
+        """Return a view on the whole buffer, oldest sample first."""
+        return self.get_last_data(self.n_samples)
+
+
+class LatencyHistogram():
+    """
+    Running histogram of latencies, with a fixed memory footprint.
+
+    Latencies are counted in logarithmically spaced bins between 1 us and
+    100 s, so percentiles are known within the width of one bin (about 6%
+    with 40 bins per decade).
+    """
+
+    def __init__(self, bins_per_decade=40, min_latency=1e-6,
+                 max_latency=100.):
+        self.edges = np.logspace(np.log10(min_latency),
+                                 np.log10(max_latency),
+                                 int(bins_per_decade * np.log10(
+                                     max_latency / min_latency)) + 1)
+        # One more bin on each side for the out of range values
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, latency):
+        """Count one latency, in seconds."""
+        self.counts[np.searchsorted(self.edges, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """Return the upper edge of the bin holding the q-th percentile."""
+        if self.count == 0:
+            return np.nan
+        i_bin = np.searchsorted(np.cumsum(self.counts), q / 100. * self.count)
+        if i_bin >= len(self.edges):
+            return self.max
+        return min(self.edges[i_bin], self.max)
+
+    def summary(self):
+        """Return the count, mean, max and the p50/p95/p99 percentiles."""
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else np.nan,
+                'max': float(self.max),
+                'p50': float(self.percentile(50)),
+                'p95': float(self.percentile(95)),
+                'p99': float(self.percentile(99))}
+
+
+class LatencyMonitor():
+    """
+    Latency histograms of the stages of a real-time loop.
+
+    The loop records the duration of each stage, and the age of the newest
+    sample used for the decision, with record(). The histograms are only
+    written by the loop, so a monitor can poll get_summary() at any time.
+    """
+
+    def __init__(self, stages):
+        """Initialize.
+
+        Args:
+            stages (list): names of the latencies recorded
+        """
+        self.stages = list(stages)
+        self.histograms = dict((stage, LatencyHistogram())
+                               for stage in self.stages)
+
+    def record(self, **latencies):
+        """Record latencies in seconds, given as stage=latency."""
+        for stage, latency in latencies.items():
+            self.histograms[stage].add(latency)
+
+    def get_summary(self):
+        """Return the summary of every stage, see LatencyHistogram.summary."""
+        return dict((stage, self.histograms[stage].summary())
+                    for stage in self.stages)
+
+    def report(self):
+        """Return the summary as a table, in milliseconds."""
+        lines = ['%-16s %8s %9s %9s %9s %9s %9s' % (
+                 'stage', 'count', 'mean', 'p50', 'p95', 'p99', 'max')]
+        for stage in self.stages:
+            summary = self.histograms[stage].summary()
+            lines.append('%-16s %8d %9.2f %9.2f %9.2f %9.2f %9.2f' % (
+                stage, summary['count'], summary['mean'] * 1e3,
+                summary['p50'] * 1e3, summary['p95'] * 1e3,
+                summary['p99'] * 1e3, summary['max'] * 1e3))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        """Write the summary to a JSON file, in seconds."""
+        with open(filename, 'w') as f:
+            json.dump(self.get_summary(), f, indent=2)
+
+
 class DataPlotter():
     """
     Class for creating and updating a line plot.
+
+    In fast mode, the axes and labels are drawn once and cached, and only
+    the lines are redrawn on top of them (blitting). Lines longer than the
+    width of the axes in pixels are reduced to the minimum and maximum of
+    the samples falling in each pixel column, which looks the same, and
+    the plot is not redrawn when the data did not change.
     """
 
-    def __init__(self, nbPoints, chNames, fs=None, title=None):
-        """Initialize the figure."""
+    def __init__(self, nbPoints, chNames, fs=None, title=None, fast=False):
+        """Initialize the figure.
+
+        Keyword Args:
+            fast (bool): use the fast rendering mode. Blitting is only used
+                if the canvas supports it. Off by default, so the whole
+                figure is redrawn on every update.
+        """
 
         self.nbPoints = nbPoints
         self.chNames = chNames
@@ -341,29 +1404,100 @@ class DataPlotter():
         # Initialize the figure
         self.ax.set_title(self.figTitle)
 
+        self.fast = fast
+        self.blit = fast and getattr(self.fig.canvas, 'supports_blit', False)
+        self.background = None
+        self.lastData = None
+
         self.chLinesDict = {}
         for i, chName in enumerate(self.chNames):
             self.chLinesDict[chName], = self.ax.plot(
-                    self.t, data+self.offsets[i], label=chName)
+                    self.t, data+self.offsets[i], label=chName,
+                    animated=self.blit)
 
         self.ax.set_xlabel('Time')
         self.ax.set_ylim([0, self.yAxisRange])
         self.ax.set_xlim([np.min(self.t), np.max(self.t)])
 
+        if self.blit:
+            # Every full draw (first show, resize, ...) renders the static
+            # parts, which are then cached as background
+            self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+
         plt.show()
 
+    def _on_draw(self, event):
+        """Cache the background and draw the lines over it."""
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self._blit_lines()
+
+    def _blit_lines(self):
+        """Draw the lines over the cached background."""
+        self.fig.canvas.restore_region(self.background)
+        for line in self.chLinesDict.values():
+            self.ax.draw_artist(line)
+        self.fig.canvas.blit(self.ax.bbox)
+
+    def _decimate(self, data):
+        """Reduce the data to the min and max of each pixel column.
+
+        Returns:
+            (numpy.ndarray): time of the points kept, for each channel
+            (numpy.ndarray): the points kept, for each channel
+        """
+        n_bins = max(int(self.ax.bbox.width), 1)
+        if self.nbPoints <= 2 * n_bins:
+            return np.tile(self.t[:, np.newaxis], (1, self.nbCh)), data
+
+        per_bin = int(np.ceil(self.nbPoints / float(n_bins)))
+        n_bins = int(np.ceil(self.nbPoints / float(per_bin)))
+        n_pad = n_bins * per_bin - self.nbPoints
+        binned = np.pad(data, ((0, n_pad), (0, 0)), mode='edge').reshape(
+                n_bins, per_bin, self.nbCh)
+
+        # Keep the min and the max of each bin in their time order
+        start = np.arange(n_bins)[:, np.newaxis] * per_bin
+        i_min = np.minimum(start + np.argmin(binned, axis=1),
+                           self.nbPoints - 1)
+        i_max = np.minimum(start + np.argmax(binned, axis=1),
+                           self.nbPoints - 1)
+        index = np.empty((2 * n_bins, self.nbCh), dtype=int)
+        index[0::2] = np.minimum(i_min, i_max)
+        index[1::2] = np.maximum(i_min, i_max)
+
+        return self.t[index], np.take_along_axis(data, index, axis=0)
+
     def update_plot(self, data):
         """ Update the plot """
 
+        if self.fast:
+            if self.lastData is not None and \
+                    np.array_equal(data, self.lastData):
+                return
+            self.lastData = np.array(data)
+
         data = data - np.mean(data, axis=0)
         std_data = np.std(data, axis=0)
         std_data[np.where(std_data == 0)] = 1
         data = data/std_data*self.chRange/5.0
 
-        for i, chName in enumerate(self.chNames):
-            self.chLinesDict[chName].set_ydata(data[:, i] + self.offsets[i])
-
-        self.fig.canvas.draw()
+        # Offset the channels without converting single precision data to
+        # double precision
+        offsets = self.offsets.astype(data.dtype)
+        if self.fast:
+            t, data = self._decimate(data)
+            data += offsets
+            for i, chName in enumerate(self.chNames):
+                self.chLinesDict[chName].set_data(t[:, i], data[:, i])
+        else:
+            data += offsets
+            for i, chName in enumerate(self.chNames):
+                self.chLinesDict[chName].set_ydata(data[:, i])
+
+        if self.blit and self.background is not None:
+            self._blit_lines()
+        else:
+            self.fig.canvas.draw()
 
     def clear(self):
         """ Clear the figure """
@@ -371,7 +1505,8 @@ class DataPlotter():
         blankData = np.empty((self.nbPoints, 1))*np.nan
 
         for i, chName in enumerate(self.chNames):
-            self.chLinesDict[chName].set_ydata(blankData)
+            self.chLinesDict[chName].set_data(self.t, blankData)
+        self.lastData = None
 
         self.fig.canvas.draw()
 
@@ -381,9 +1516,106 @@ class DataPlotter():
         plt.close(self.fig)
 
 
-def plot_classifier_training(clf, X, y, features_to_plot=[0, 1]):
+def _predict_chunks(clf, points, n_jobs=-1, chunk_size=4096):
+    """Predict the labels of many points, in chunks predicted in parallel.
+
+    The predictions of sklearn's SVC and linear models release the GIL, so
+    the chunks are predicted by threads sharing the classifier.
+    """
+    if len(points) <= chunk_size:
+        return clf.predict(points)
+    chunks = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(clf.predict)(points[i:i + chunk_size])
+            for i in range(0, len(points), chunk_size))
+    return np.concatenate(chunks)
+
+
+def predict_grid(clf, make_points, shape, coarse_cells=32, n_jobs=-1,
+                 time_budget=None):
+    """Predict the labels of a regular 2-D grid, coarse to fine.
+
+    The grid is first predicted every 2^k points, with about
+    "coarse_cells" cells along its longest side. Each refinement halves the
+    step and only predicts the new points of the cells whose corners are
+    not all of the same class, the other points take the class of their
+    cell. Regions of one class narrower than a coarse cell can be missed.
+
+    Args:
+        clf (sklearn object): trained classifier
+        make_points (function): returns the inputs of the classifier at
+            grid indices (rows, columns), two arrays of the same length.
+            Indices past the end of the grid must be accepted.
+        shape (tuple): number of rows and columns of the grid
+
+    Keyword Args:
+        coarse_cells (int): number of cells of the coarsest grid along its
+            longest side
+        n_jobs (int): number of parallel workers, -1 for all the cores
+        time_budget (float): stop refining after that many seconds, the
+            points left take the class of their cell. No limit by default.
+
+    Returns:
+        (numpy.ndarray): labels of the grid, of shape "shape"
+        (int): number of points predicted
+    """
+    start = perf_counter()
+    stride = 1
+    while (max(shape) - 1) / (2 * stride) >= coarse_cells:
+        stride *= 2
+    # Pad the grid so that the coarse grid falls on its last row and column
+    n_rows, n_cols = [int(np.ceil((n - 1) / stride)) * stride + 1
+                      for n in shape]
+
+    rows, cols = np.mgrid[0:n_rows:stride, 0:n_cols:stride]
+    labels = _predict_chunks(clf, make_points(rows.ravel(), cols.ravel()),
+                             n_jobs)
+    Z = np.empty((n_rows, n_cols), dtype=labels.dtype)
+    Z[::stride, ::stride] = labels.reshape(rows.shape)
+    n_predicted = labels.size
+
+    while stride > 1:
+        coarse = Z[::stride, ::stride]
+        half = stride // 2
+
+        # Cells whose four corners are not all of the same class
+        mixed = ((coarse[:-1, :-1] != coarse[1:, :-1]) |
+                 (coarse[:-1, :-1] != coarse[:-1, 1:]) |
+                 (coarse[:-1, :-1] != coarse[1:, 1:]))
+        if time_budget is not None and perf_counter() - start > time_budget:
+            mixed[:] = False
+
+        # Points of the finer grid on a mixed cell, edges included
+        n_fine = (2 * coarse.shape[0] - 1, 2 * coarse.shape[1] - 1)
+        refine = np.zeros(n_fine, dtype=bool)
+        for i in range(3):
+            for j in range(3):
+                refine[i:i + n_fine[0] - 2:2, j:j + n_fine[1] - 2:2] |= mixed
+        refine[::2, ::2] = False  # already known
+
+        # The other points are in cells of a single class, take it from
+        # their top-left corner
+        fine = Z[::half, ::half]
+        fine[...] = np.repeat(np.repeat(coarse, 2, axis=0), 2,
+                              axis=1)[:n_fine[0], :n_fine[1]]
+
+        rows, cols = np.nonzero(refine)
+        if len(rows):
+            fine[rows, cols] = _predict_chunks(
+                    clf, make_points(rows * half, cols * half), n_jobs)
+            n_predicted += len(rows)
+        stride = half
+
+    return Z[:shape[0], :shape[1]], n_predicted
+
+
+def plot_classifier_training(clf, X, y, features_to_plot=[0, 1],
+                             plot_step=0.02, coarse_cells=32, n_jobs=-1,
+                             time_budget=None):
     """Visualize the decision boundary of a classifier.
 
+    The decision regions are predicted coarse to fine, see predict_grid.
+    The features that are not plotted are set to their mean.
+
     Args:
         clf (sklearn object): trained classifier
         X (numpy.ndarray): data to visualize the decision boundary for
@@ -392,24 +1624,37 @@ def plot_classifier_training(clf, X, y, features_to_plot=[0, 1]):
     Keyword Args:
         features_to_plot (list): indices of the two features to use for
             plotting
+        plot_step (float): resolution of the decision regions
+        coarse_cells (int): see predict_grid
+        n_jobs (int): number of parallel workers, -1 for all the cores
+        time_budget (float): maximum time spent refining the decision
+            regions, in seconds. No limit by default.
 
     Inspired from: http://scikit-learn.org/stable/auto_examples/tree/plot_iris.html
     """
 
     plot_colors = "bry"
-    plot_step = 0.02
     n_classes = len(np.unique(y))
+    feat_x, feat_y = features_to_plot
+
+    x_min = np.min(X[:, feat_x])-1
+    x_max = np.max(X[:, feat_x])+1
+    y_min = np.min(X[:, feat_y])-1
+    y_max = np.max(X[:, feat_y])+1
 
-    x_min = np.min(X[:, 1])-1
-    x_max = np.max(X[:, 1])+1
-    y_min = np.min(X[:, 0])-1
-    y_max = np.max(X[:, 0])+1
+    x_grid = np.arange(x_min, x_max, plot_step)
+    y_grid = np.arange(y_min, y_max, plot_step)
+    mean = np.mean(X, axis=0)
 
-    xx, yy = np.meshgrid(np.arange(x_min, x_max, plot_step),
-                         np.arange(y_min, y_max, plot_step))
+    def make_points(rows, cols):
+        points = np.tile(mean, (len(rows), 1))
+        points[:, feat_x] = x_min + cols * plot_step
+        points[:, feat_y] = y_min + rows * plot_step
+        return points
 
-    Z = clf.predict(np.c_[xx.ravel(), yy.ravel()])
-    Z = Z.reshape(xx.shape)
+    Z, _ = predict_grid(clf, make_points, (len(y_grid), len(x_grid)),
+                        coarse_cells, n_jobs, time_budget)
+    xx, yy = np.meshgrid(x_grid, y_grid)
 
     fig, ax = plt.subplots()
     ax.contourf(xx, yy, Z, cmap=plt.cm.Paired, alpha=0.5)
@@ -417,6 +1662,7 @@ def plot_classifier_training(clf, X, y, features_to_plot=[0, 1]):
     # Plot the training points
     for i, color in zip(range(n_classes), plot_colors):
         idx = np.where(y == i)
-        ax.scatter(X[idx, 0], X[idx, 1], c=color, cmap=plt.cm.Paired)
+        ax.scatter(X[idx, feat_x], X[idx, feat_y], c=color,
+                   cmap=plt.cm.Paired)
 
     plt.axis('tight')
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the workshop toolbox hot paths
+
+Runs every benchmark on synthetic data over a grid of channel counts, epoch
+lengths and recording durations, and writes the timings to a JSON file.
+Given the JSON file of a previous run, the timings are compared and the
+script exits with an error if any benchmark got slower than the threshold.
+
+Usage:
+    python benchmarks.py --output results.json
+    python benchmarks.py --baseline results.json --threshold 1.25
+    python benchmarks.py --quick --filter feature
+    python benchmarks.py --float32 --baseline results.json
+
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import sys
+import timeit
+
+import numpy as np
+
+import bci_workshop_tools as BCIw
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FS = 256
+
+CHANNELS = [4, 16, 64]
+EPOCH_LENGTHS = [1, 2]
+DURATIONS = [60, 600]
+
+QUICK_CHANNELS = [4, 64]
+QUICK_EPOCH_LENGTHS = [1]
+QUICK_DURATIONS = [60]
+
+
+def time_function(func, min_time=0.2, repeat=5):
+    """Time a function without arguments.
+
+    The number of calls per measurement is chosen so that one measurement
+    lasts at least "min_time" seconds.
+
+    Returns:
+        (dict): best and median time per call in seconds, and the number of
+            calls per measurement
+    """
+    timer = timeit.Timer(func)
+    number, time_taken = timer.autorange()
+    number = max(int(np.ceil(number * min_time / time_taken)), 1)
+
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return {'best': float(np.min(times)),
+            'median': float(np.median(times)),
+            'number': number}
+
+
+def random_eeg(n_samples, n_channels, seed=0):
+    """Synthetic EEG: 10 Hz rhythm plus noise, in microvolts, as DTYPE."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_samples) / float(FS)
+    data = 20 * rng.randn(n_samples, n_channels)
+    data += 10 * np.sin(2 * np.pi * 10 * t)[:, np.newaxis]
+    return data.astype(BCIw.DTYPE)
+
+
+def load_script(name, filename):
+    """Import one of the scripts of the workshop as a module."""
+    spec = importlib.util.spec_from_file_location(
+            name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Benchmarks. Each one yields (params, func) pairs for the given grid.
+
+def bench_epoch(grid):
+    for n_channels in grid['channels']:
+        for epoch_length in grid['epoch_lengths']:
+            for duration in grid['durations']:
+                data = random_eeg(duration * FS, n_channels)
+                samples_epoch = epoch_length * FS
+                samples_overlap = int(0.8 * samples_epoch)
+                params = {'channels': n_channels, 'epoch': epoch_length,
+                          'duration': duration}
+                yield (dict(params, view=False),
+                       lambda: BCIw.epoch(data, samples_epoch,
+                                          samples_overlap))
+                yield (dict(params, view=True),
+                       lambda: BCIw.epoch(data, samples_epoch,
+                                          samples_overlap, view=True))
+
+
+def bench_compute_feature_vector(grid):
+    for n_channels in grid['channels']:
+        for epoch_length in grid['epoch_lengths']:
+            data = random_eeg(epoch_length * FS, n_channels)
+            yield ({'channels': n_channels, 'epoch': epoch_length},
+                   lambda: BCIw.compute_feature_vector(data, FS))
+
+
+def bench_sliding_band_power(grid):
+    # Same windows as bench_compute_feature_vector, shifted by 0.2 s
+    for n_channels in grid['channels']:
+        for epoch_length in grid['epoch_lengths']:
+            band_power = BCIw.SlidingBandPower(epoch_length * FS, n_channels,
+                                               FS)
+            chunk = random_eeg(int(0.2 * FS), n_channels)
+            yield ({'channels': n_channels, 'epoch': epoch_length},
+                   lambda: band_power.update(chunk))
+
+
+def bench_compute_feature_matrix(grid):
+    for n_channels in grid['channels']:
+        for epoch_length in grid['epoch_lengths']:
+            for duration in grid['durations']:
+                samples_epoch = epoch_length * FS
+                epochs = BCIw.epoch(random_eeg(duration * FS, n_channels),
+                                    samples_epoch, int(0.8 * samples_epoch),
+                                    view=True)
+                yield ({'channels': n_channels, 'epoch': epoch_length,
+                        'duration': duration},
+                       lambda: BCIw.compute_feature_matrix(epochs, FS,
+                                                           batch_size=256))
+
+
+def bench_update_buffer(grid):
+    # 15 s buffer updated with 0.2 s chunks, as in the exercises
+    for n_channels in grid['channels']:
+        chunk = random_eeg(int(0.2 * FS), n_channels)
+        state = {'buffer': np.zeros((15 * FS, n_channels),
+                                    dtype=BCIw.DTYPE),
+                 'filter_state': None}
+
+        def update_buffer():
+            state['buffer'], state['filter_state'] = BCIw.update_buffer(
+                    state['buffer'], chunk, notch=True,
+                    filter_state=state['filter_state'])
+
+        ring_buffer = BCIw.RingBuffer(15 * FS, n_channels, notch=True)
+        yield ({'channels': n_channels, 'ring': False}, update_buffer)
+        yield ({'channels': n_channels, 'ring': True},
+               lambda: ring_buffer.update(chunk))
+
+
+def bench_test_classifier(grid):
+    for n_channels in grid['channels']:
+        n_features = 4 * n_channels
+        rng = np.random.RandomState(0)
+        feat0 = rng.randn(100, n_features)
+        feat1 = rng.randn(100, n_features) + 0.5
+        clf, mu_ft, std_ft, _ = BCIw.train_classifier(feat0, feat1)
+        x = rng.randn(1, n_features)
+        yield ({'channels': n_channels},
+               lambda: BCIw.test_classifier(clf, x, mu_ft, std_ft))
+
+
+def bench_compiled_classifier(grid):
+    # Same classifiers as bench_test_classifier
+    for n_channels in grid['channels']:
+        n_features = 4 * n_channels
+        rng = np.random.RandomState(0)
+        feat0 = rng.randn(100, n_features)
+        feat1 = rng.randn(100, n_features) + 0.5
+        clf, mu_ft, std_ft, _ = BCIw.train_classifier(feat0, feat1)
+        evaluator = BCIw.CompiledClassifier(clf, mu_ft, std_ft)
+        x = rng.randn(1, n_features)
+        yield ({'channels': n_channels}, lambda: evaluator.predict(x))
+
+
+def bench_unpack_eeg_channel(grid):
+    from muse.muse import Muse, unpack_eeg_packets
+    muse = Muse()
+    rng = np.random.RandomState(0)
+    packet = bytearray(rng.randint(0, 256, 20).astype(np.uint8).tobytes())
+    block = rng.randint(0, 256, 20 * 1000).astype(np.uint8).tobytes()
+    yield ({'packets': 1}, lambda: muse._unpack_eeg_channel(packet))
+    yield ({'packets': 1000}, lambda: unpack_eeg_packets(block))
+
+
+def bench_mules_parsedata(grid):
+    mules = load_script('mules', os.path.join('extra_stuff', 'mules.py'))
+    for n_channels in grid['channels']:
+        client = mules.MulesClient.__new__(mules.MulesClient)
+        client.python2 = False
+        client.params = {'data format': 'f' * n_channels,
+                         'sampling frequency': FS}
+        package = random_eeg(FS, n_channels).astype('>f4').tobytes()
+        yield ({'channels': n_channels, 'seconds': 1},
+               lambda: client.parsedata(package))
+
+
+def bench_lsl_viewer_chunk(grid):
+    lsl_viewer = load_script('lsl_viewer', 'lsl-viewer.py')
+    for n_channels in grid['channels']:
+        viewer = lsl_viewer.LSLViewer.__new__(lsl_viewer.LSLViewer)
+        viewer.sfreq = float(FS)
+        viewer.window = 5.
+        viewer.n_chan = n_channels
+        viewer.dejitter = True
+        viewer.filter_stage = BCIw.FilterStage(n_channels, FS,
+                                               [('bandpass', (1, 40), 4)])
+        viewer._init_buffers()
+        samples = random_eeg(12, n_channels).tolist()
+        timestamps = list(np.arange(12) / float(FS))
+        yield ({'channels': n_channels},
+               lambda: viewer.ingest_chunk(samples, timestamps))
+
+
+def bench_data_plotter(grid):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')  # render off-screen
+    for n_channels in grid['channels']:
+        buffer = BCIw.RingBuffer(15 * FS, n_channels)
+        buffer.update(random_eeg(15 * FS, n_channels))
+        chunk = random_eeg(int(0.2 * FS), n_channels)
+        ch_names = ['ch%d' % i for i in range(n_channels)]
+        for fast in [False, True]:
+            plotter = BCIw.DataPlotter(15 * FS, ch_names, FS, fast=fast)
+            plotter.fig.canvas.draw()
+
+            def update_plot(plotter=plotter):
+                buffer.update(chunk)
+                plotter.update_plot(buffer.get_data())
+
+            yield ({'channels': n_channels, 'fast': fast}, update_plot)
+            plotter.close()
+
+
+BENCHMARKS = [('epoch', bench_epoch),
+              ('compute_feature_vector', bench_compute_feature_vector),
+              ('SlidingBandPower.update', bench_sliding_band_power),
+              ('compute_feature_matrix', bench_compute_feature_matrix),
+              ('update_buffer', bench_update_buffer),
+              ('test_classifier', bench_test_classifier),
+              ('CompiledClassifier.predict', bench_compiled_classifier),
+              ('Muse._unpack_eeg_channel', bench_unpack_eeg_channel),
+              ('MulesClient.parsedata', bench_mules_parsedata),
+              ('LSLViewer.ingest_chunk', bench_lsl_viewer_chunk),
+              ('DataPlotter.update_plot', bench_data_plotter)]
+
+
+def case_id(name, params):
+    """Unique identifier of a benchmark case, used to match baselines."""
+    return name + '[' + ','.join('%s=%s' % (key, params[key])
+                                 for key in sorted(params)) + ']'
+
+
+def run(grid, name_filter=None, min_time=0.2):
+    """Run the benchmarks and return the results as a dict."""
+    results = {}
+    for name, bench in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        try:
+            for params, func in bench(grid):
+                timing = time_function(func, min_time=min_time)
+                timing.update({'name': name, 'params': params})
+                results[case_id(name, params)] = timing
+                print('%-70s %12.3f us' % (case_id(name, params),
+                                           timing['median'] * 1e6))
+        except ImportError as e:
+            print('%-70s skipped (%s)' % (name, e))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compare results to a baseline.
+
+    Returns:
+        (list): identifiers of the cases slower than "threshold" times the
+            baseline
+    """
+    regressions = []
+    print('\n%-70s %10s' % ('Comparison to baseline', 'ratio'))
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        ratio = results[key]['median'] / baseline[key]['median']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('%-70s %10.2f%s' % (key, ratio, flag))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            description='Microbenchmarks of the workshop toolbox')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the results to')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON file of a previous run to compare to')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--filter', default=None,
+                        help='only run the benchmarks whose name contains '
+                             'this string')
+    parser.add_argument('--quick', action='store_true',
+                        help='run on a smaller grid')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of one measurement in '
+                             'seconds')
+    parser.add_argument('--float32', action='store_true',
+                        help='process the data in single precision')
+    args = parser.parse_args()
+
+    if args.float32:
+        BCIw.DTYPE = np.float32
+
+    if args.quick:
+        grid = {'channels': QUICK_CHANNELS,
+                'epoch_lengths': QUICK_EPOCH_LENGTHS,
+                'durations': QUICK_DURATIONS}
+    else:
+        grid = {'channels': CHANNELS, 'epoch_lengths': EPOCH_LENGTHS,
+                'durations': DURATIONS}
+
+    results = run(grid, args.filter, args.min_time)
+
+    if args.output:
+        output = {'meta': {'date': datetime.datetime.now().isoformat(),
+                           'python': sys.version.split()[0],
+                           'numpy': np.__version__,
+                           'platform': platform.platform(),
+                           'dtype': np.dtype(BCIw.DTYPE).name,
+                           'grid': grid},
+                  'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%d regression(s)' % len(regressions))
+            sys.exit(1)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration bundles
+
+A calibration bundle is a directory holding everything needed to classify
+in real time without recording calibration data again:
+
+    calibration.json     format version, sampling frequency, channels,
+                         feature plan and training score
+    normalization.npy    mean and standard deviation of the features,
+                         [2, n_features]
+    classifier.joblib    trained classifier, with its arrays uncompressed
+
+The arrays are memory-mapped when the bundle is loaded, so loading takes a
+few milliseconds whatever the size of the classifier. The metadata is
+written last: a directory without it is not a valid bundle.
+"""
+
+import datetime
+import json
+import os
+
+import joblib
+import numpy as np
+import sklearn
+
+import bci_workshop_tools as BCIw
+
+
+VERSION = 1
+METADATA_FILE = 'calibration.json'
+NORMALIZATION_FILE = 'normalization.npy'
+CLASSIFIER_FILE = 'classifier.joblib'
+
+
+def save_calibration(path, clf, mu_ft, std_ft, plan, channels, ch_names,
+                     score):
+    """Save a trained classifier and its context to a bundle.
+
+    Args:
+        path (str): directory of the bundle, created if needed. The files
+            of a previous bundle are overwritten.
+        clf (sklearn object): trained classifier
+        mu_ft (numpy.ndarray): normalization mean
+        std_ft (numpy.ndarray): normalization standard deviation
+        plan (FeaturePlan): plan of the features the classifier was
+            trained on, its sampling frequency is the one of the stream
+        channels (list): indices of the channels used in the stream
+        ch_names (list): names of these channels
+        score (float): training score of the classifier
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    metadata_file = os.path.join(path, METADATA_FILE)
+    if os.path.exists(metadata_file):
+        # Invalidate the previous bundle until this one is complete
+        os.remove(metadata_file)
+
+    np.save(os.path.join(path, NORMALIZATION_FILE),
+            np.vstack([mu_ft, std_ft]))
+    joblib.dump(clf, os.path.join(path, CLASSIFIER_FILE))
+
+    metadata = {'version': VERSION,
+                'date': datetime.datetime.now().isoformat(),
+                'sklearn': sklearn.__version__,
+                'classifier': type(clf).__name__,
+                'fs': float(plan.fs),
+                'channels': [int(ch) for ch in channels],
+                'ch_names': list(ch_names),
+                'score': float(score),
+                'n_features': int(len(mu_ft)),
+                'feature_plan': {'n_samples': plan.n_samples,
+                                 'bands': plan.bands,
+                                 'ratios': plan.ratios,
+                                 'features': plan.features}}
+    with open(metadata_file, 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def load_calibration(path, mmap=True):
+    """Load a bundle saved by save_calibration.
+
+    Args:
+        path (str): directory of the bundle
+
+    Keyword Args:
+        mmap (bool): if True, the arrays are read-only memory maps
+
+    Returns:
+        (dict): the classifier ('clf'), the normalization ('mu_ft',
+            'std_ft'), the feature plan ('plan'), 'channels', 'ch_names',
+            'fs', 'score' and the whole 'metadata'
+    """
+    metadata_file = os.path.join(path, METADATA_FILE)
+    if not os.path.exists(metadata_file):
+        raise ValueError('%s is not a calibration bundle' % path)
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+    if metadata['version'] > VERSION:
+        raise ValueError('Calibration bundle version %d is not supported'
+                         % metadata['version'])
+
+    mmap_mode = 'r' if mmap else None
+    normalization = np.load(os.path.join(path, NORMALIZATION_FILE),
+                            mmap_mode=mmap_mode)
+    clf = joblib.load(os.path.join(path, CLASSIFIER_FILE),
+                      mmap_mode=mmap_mode)
+
+    plan_params = metadata['feature_plan']
+    plan = BCIw.get_feature_plan(metadata['fs'], plan_params['n_samples'],
+                                 plan_params['bands'], plan_params['ratios'],
+                                 plan_params['features'])
+
+    return {'clf': clf, 'mu_ft': normalization[0],
+            'std_ft': normalization[1], 'plan': plan,
+            'channels': metadata['channels'],
+            'ch_names': metadata['ch_names'], 'fs': metadata['fs'],
+            'score': metadata['score'], 'metadata': metadata}
+
+
+def check_calibration(calibration, fs, ch_names):
+    """Check that a bundle can be used with a stream.
+
+    Args:
+        calibration (dict): bundle returned by load_calibration
+        fs (float): sampling frequency of the stream
+        ch_names (list): names of all the channels of the stream
+
+    Returns:
+        (str): why the bundle cannot be used, or None if it can
+    """
+    if calibration['fs'] != fs:
+        return 'the bundle was calibrated at %g Hz and the stream is at ' \
+               '%g Hz' % (calibration['fs'], fs)
+    if max(calibration['channels']) >= len(ch_names):
+        return 'the stream has only %d channels' % len(ch_names)
+    names = [ch_names[i] for i in calibration['channels']]
+    if names != calibration['ch_names']:
+        return 'the bundle uses the channels %s and the stream has %s' % (
+            ', '.join(calibration['ch_names']), ', '.join(names))
+    return None
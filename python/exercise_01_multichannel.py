@@ -10,15 +10,29 @@ powers and displays both the raw signals and the features.
 
 """
 
+import argparse
 import numpy as np  # Module that simplifies computations on matrices
 import matplotlib.pyplot as plt  # Module used for plotting
 from pylsl import StreamInlet, resolve_byprop  # Module to receive EEG data
 
 import bci_workshop_tools as BCIw  # Our own functions for the workshop
+import bci_pipeline as BCIpipe  # Acquisition and features in other processes
 
 
 if __name__ == "__main__":
 
+    """ 0. PARSE ARGUMENTS """
+    parser = argparse.ArgumentParser(description='BCI Workshop example 1b')
+    parser.add_argument('--pipeline', action='store_true',
+        help='acquire and compute the features in separate processes, so '
+             'that plotting does not delay them')
+    parser.add_argument('--float32', action='store_true',
+        help='process the EEG in single precision')
+
+    args = parser.parse_args()
+    if args.float32:
+        BCIw.DTYPE = np.float32
+
     """ 1. CONNECT TO EEG STREAM """
 
     # Search for active LSL stream
@@ -69,25 +83,33 @@ if __name__ == "__main__":
 
     # Get names of features
     # ex. ['delta - CH1', 'pwr-theta - CH1', 'pwr-alpha - CH1',...]
-    feature_names = BCIw.get_feature_names(ch_names)
+    plan = BCIw.get_feature_plan(fs, int(epoch_length * fs))
+    feature_names = BCIw.get_feature_names(ch_names, plan)
 
     """3. INITIALIZE BUFFERS """
 
     # Initialize raw EEG data buffer (for plotting)
-    eeg_buffer = np.zeros((int(fs * buffer_length), n_channels))
-    filter_state = None  # for use with the notch filter
+    # (the notch filter is applied as data comes in, by the compute process
+    # in pipeline mode)
+    eeg_buffer = BCIw.RingBuffer(int(fs * buffer_length), n_channels,
+                                 notch=not args.pipeline, fs=fs)
+
+    # Band powers of the newest epoch, updated as the filtered data comes in
+    band_power = BCIw.SlidingBandPower(plan.n_samples, n_channels, fs,
+                                       plan=plan)
 
     # Compute the number of epochs in "buffer_length" (used for plotting)
     n_win_test = int(np.floor((buffer_length - epoch_length) /
                               shift_length + 1))
 
     # Initialize the feature data buffer (for plotting)
-    feat_buffer = np.zeros((n_win_test, len(feature_names)))
+    feat_buffer = BCIw.RingBuffer(n_win_test, len(feature_names))
 
     # Initialize the plots
-    plotter_eeg = BCIw.DataPlotter(fs * buffer_length, ch_names, fs)
+    plotter_eeg = BCIw.DataPlotter(fs * buffer_length, ch_names, fs,
+                                   fast=True)
     plotter_feat = BCIw.DataPlotter(n_win_test, feature_names,
-                                    1 / shift_length)
+                                    1 / shift_length, fast=True)
 
     """ 3. GET DATA """
 
@@ -95,10 +117,31 @@ if __name__ == "__main__":
     # script with <Ctrl-C>
     print('Press Ctrl-C in the console to break the while loop.')
 
+    if args.pipeline:
+        # The acquisition process opens its own inlet
+        inlet.close_stream()
+        pipeline = BCIpipe.Pipeline(BCIpipe.stream_selector(info), fs,
+                                    index_channel, epoch_length, shift_length)
+        pipeline.start()
+
     try:
+        if args.pipeline:
+            # Only visualize here, as fast as the plots can be redrawn
+            while pipeline.is_alive():
+                results = pipeline.get_results(timeout=1)
+                if not results:
+                    continue
+                for result in results:
+                    eeg_buffer.update(result['eeg'])
+                    feat_buffer.update(np.atleast_2d(result['features']))
+
+                plotter_eeg.update_plot(eeg_buffer.get_data())
+                plotter_feat.update_plot(feat_buffer.get_data())
+                plt.pause(0.00001)
+
         # The following loop does what we see in the diagram of Exercise 1:
         # acquire data, compute features, visualize raw EEG and the features
-        while True:
+        while not args.pipeline:
 
             """ 3.1 ACQUIRE DATA """
             # Obtain EEG data from the LSL stream
@@ -109,25 +152,24 @@ if __name__ == "__main__":
             ch_data = np.array(eeg_data)[:, index_channel]
 
             # Update EEG buffer
-            eeg_buffer, filter_state = BCIw.update_buffer(
-                    eeg_buffer, ch_data, notch=True,
-                    filter_state=filter_state)
+            eeg_buffer.update(ch_data)
 
             """ 3.2 COMPUTE FEATURES """
-            # Get newest samples from the buffer
-            data_epoch = BCIw.get_last_data(eeg_buffer,
-                                            epoch_length * fs)
-
-            # Compute features
-            feat_vector = BCIw.compute_feature_vector(data_epoch, fs)
-            feat_buffer, _ = BCIw.update_buffer(feat_buffer,
-                                                np.asarray([feat_vector]))
+            # Slide the epoch over the newest filtered samples and compute
+            # its features
+            feat_vector = band_power.update(
+                    eeg_buffer.get_last_data(ch_data.shape[0]))
+            feat_buffer.update(np.asarray([feat_vector]))
 
             """ 3.3 VISUALIZE THE RAW EEG AND THE FEATURES """
-            plotter_eeg.update_plot(eeg_buffer)
-            plotter_feat.update_plot(feat_buffer)
+            plotter_eeg.update_plot(eeg_buffer.get_data())
+            plotter_feat.update_plot(feat_buffer.get_data())
             plt.pause(0.00001)
 
     except KeyboardInterrupt:
 
         print('Closing!')
+
+    if args.pipeline:
+        pipeline.stop()
+        print(pipeline.report())
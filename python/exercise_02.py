@@ -12,11 +12,14 @@ and can then classify similar unseen information.
 """
 
 import argparse
+import os
 import numpy as np  # Module that simplifies computations on matrices
 import matplotlib.pyplot as plt  # Module used for plotting
-from pylsl import StreamInlet, resolve_byprop  # Module to receive EEG data
+from pylsl import StreamInlet, resolve_byprop, local_clock  # Module to receive EEG data
 
 import bci_workshop_tools as BCIw  # Our own functions for the workshop
+import bci_pipeline as BCIpipe  # Acquisition and decisions in other processes
+import calibration as BCIcal  # Save and load trained classifiers
 
 
 if __name__ == "__main__":
@@ -26,8 +29,32 @@ if __name__ == "__main__":
     parser.add_argument('channels', metavar='N', type=int, nargs='*',
         default=[0, 1, 2, 3],
         help='channel number to use. If not specified, all the channels are used')
+    parser.add_argument('--latency-log', default=None,
+        help='JSON file to write the latency percentiles to when closing')
+    parser.add_argument('--pipeline', action='store_true',
+        help='acquire, compute the features and classify in separate '
+             'processes, so that plotting does not delay the decisions')
+    parser.add_argument('--calibration', default=None,
+        help='directory of the calibration bundle. It is loaded instead of '
+             'recording training data if it exists, and saved after '
+             'training otherwise')
+    parser.add_argument('--recalibrate', action='store_true',
+        help='record training data even if the calibration bundle exists')
+    parser.add_argument('--select', choices=['grid', 'random'], default=None,
+        help='select the classifier and its hyperparameters by '
+             'cross-validation instead of using a default SVM')
+    parser.add_argument('--online', action='store_true',
+        help='keep training a linear classifier during the session. Press '
+             '0 or 1 in the decision window to label the next epochs, any '
+             'other key to stop labeling')
+    parser.add_argument('--float32', action='store_true',
+        help='process the EEG in single precision')
 
     args = parser.parse_args()
+    if args.online and (args.pipeline or args.select):
+        parser.error('--online cannot be used with --pipeline or --select')
+    if args.float32:
+        BCIw.DTYPE = np.float32
 
     """ 1. CONNECT TO EEG STREAM """
 
@@ -73,99 +100,229 @@ if __name__ == "__main__":
     # Index of the channel (electrode) to be used
     # 0 = left ear, 1 = left forehead, 2 = right forehead, 3 = right ear
     index_channel = args.channels
+
+    # Load the previous calibration, if it was made on a similar stream
+    calibration = None
+    if args.calibration and not args.recalibrate and not args.online and \
+            os.path.isdir(args.calibration):
+        calibration = BCIcal.load_calibration(args.calibration)
+        problem = BCIcal.check_calibration(calibration, fs, ch_names)
+        if problem is not None:
+            print('Calibrating again, ' + problem)
+            calibration = None
+        else:
+            index_channel = calibration['channels']
+            epoch_length = calibration['plan'].n_samples / fs
+            shift_length = epoch_length - overlap_length
+
     # Name of our channel for plotting purposes
     ch_names = [ch_names[i] for i in index_channel]
     n_channels = len(index_channel)
 
     # Get names of features
     # ex. ['delta - CH1', 'pwr-theta - CH1', 'pwr-alpha - CH1',...]
-    feature_names = BCIw.get_feature_names(ch_names)
+    if calibration is None:
+        plan = BCIw.get_feature_plan(fs, epoch_length * fs)
+    else:
+        plan = calibration['plan']
+    feature_names = BCIw.get_feature_names(ch_names, plan)
 
     # Number of seconds to collect training data for (one class)
     training_length = 20
 
-    """ 3. RECORD TRAINING DATA """
-
-    # Record data for mental activity 0
-    BCIw.beep()
-    eeg_data0, timestamps0 = inlet.pull_chunk(
-            timeout=training_length+1, max_samples=fs * training_length)
-    eeg_data0 = np.array(eeg_data0)[:, index_channel]
-
-    print('\nClose your eyes!\n')
-
-    # Record data for mental activity 1
-    BCIw.beep()  # Beep sound
-    eeg_data1, timestamps1 = inlet.pull_chunk(
-            timeout=training_length+1, max_samples=fs * training_length)
-    eeg_data1 = np.array(eeg_data1)[:, index_channel]
-
-    # Divide data into epochs
-    eeg_epochs0 = BCIw.epoch(eeg_data0, epoch_length * fs,
-                             overlap_length * fs)
-    eeg_epochs1 = BCIw.epoch(eeg_data1, epoch_length * fs,
-                             overlap_length * fs)
+    if calibration is None:
+
+        """ 3. RECORD TRAINING DATA """
+
+        # Record data for mental activity 0
+        BCIw.beep()
+        eeg_data0, timestamps0 = inlet.pull_chunk(
+                timeout=training_length+1, max_samples=fs * training_length)
+        eeg_data0 = np.array(eeg_data0, dtype=BCIw.DTYPE)[:, index_channel]
+
+        print('\nClose your eyes!\n')
+
+        # Record data for mental activity 1
+        BCIw.beep()  # Beep sound
+        eeg_data1, timestamps1 = inlet.pull_chunk(
+                timeout=training_length+1, max_samples=fs * training_length)
+        eeg_data1 = np.array(eeg_data1, dtype=BCIw.DTYPE)[:, index_channel]
+
+        # Divide data into epochs
+        eeg_epochs0 = BCIw.epoch(eeg_data0, epoch_length * fs,
+                                 overlap_length * fs)
+        eeg_epochs1 = BCIw.epoch(eeg_data1, epoch_length * fs,
+                                 overlap_length * fs)
+
+        """ 4. COMPUTE FEATURES AND TRAIN CLASSIFIER """
+
+        feat_matrix0 = BCIw.compute_feature_matrix(eeg_epochs0, fs, plan=plan)
+        feat_matrix1 = BCIw.compute_feature_matrix(eeg_epochs1, fs, plan=plan)
+
+        if args.online:
+            # The normalization forgets the epochs older than about 10 min
+            classifier = BCIw.OnlineClassifier(
+                    halflife=int(600 / shift_length))
+            score = classifier.fit(feat_matrix0, feat_matrix1)
+
+            print(str(score * 100) + '% correctly predicted')
+        elif args.select is None:
+            [classifier, mu_ft, std_ft, score] = BCIw.train_classifier(
+                    feat_matrix0, feat_matrix1, 'SVM')
+
+            print(str(score * 100) + '% correctly predicted')
+        else:
+            # Leave out the epochs overlapping with the test epochs
+            gap = int(round(epoch_length / shift_length)) - 1
+            [classifier, mu_ft, std_ft, score, report] = \
+                BCIw.train_classifier(feat_matrix0, feat_matrix1, 'all',
+                                      search=args.select, gap=gap,
+                                      return_report=True)
+
+            print(BCIw.format_selection_report(report))
+            print(str(score * 100) + '% correctly predicted in '
+                  'cross-validation')
+
+        if args.calibration and not args.online:
+            BCIcal.save_calibration(args.calibration, classifier, mu_ft,
+                                    std_ft, plan, index_channel, ch_names,
+                                    score)
+            print('Calibration saved to ' + args.calibration)
+
+        BCIw.beep()
+
+    else:
+        classifier = calibration['clf']
+        mu_ft = calibration['mu_ft']
+        std_ft = calibration['std_ft']
+        score = calibration['score']
+        print('Calibration loaded from %s (%.1f%% correctly predicted)' % (
+            args.calibration, score * 100))
+
+    if not args.online:
+        # Fold the normalization into the classifier for fast decisions
+        evaluator = BCIw.CompiledClassifier(classifier, mu_ft, std_ft)
 
-    """ 4. COMPUTE FEATURES AND TRAIN CLASSIFIER """
+    """ 5. USE THE CLASSIFIER IN REAL-TIME"""
 
-    feat_matrix0 = BCIw.compute_feature_matrix(eeg_epochs0, fs)
-    feat_matrix1 = BCIw.compute_feature_matrix(eeg_epochs1, fs)
+    # Initialize the buffers for storing raw EEG and decisions
+    # (the notch filter is applied as data comes in)
+    eeg_buffer = BCIw.RingBuffer(int(fs * buffer_length), n_channels,
+                                 notch=True, fs=fs)
+    decision_buffer = BCIw.RingBuffer(30, 1)
 
-    [classifier, mu_ft, std_ft, score] = BCIw.train_classifier(
-            feat_matrix0, feat_matrix1, 'SVM')
+    # Band powers of the newest epoch, updated as the filtered data comes in
+    band_power = BCIw.SlidingBandPower(plan.n_samples, n_channels, fs,
+                                       plan=plan)
 
-    print(str(score * 100) + '% correctly predicted')
+    plotter_decision = BCIw.DataPlotter(30, ['Decision'], fast=True)
 
-    BCIw.beep()
+    # Label of the epochs in online mode, set with the keyboard
+    feedback = {'label': None}
 
-    """ 5. USE THE CLASSIFIER IN REAL-TIME"""
+    def on_key(event):
+        feedback['label'] = int(event.key) if event.key in ['0', '1'] \
+            else None
+        print('Labeling the epochs as %s' % feedback['label'])
 
-    # Initialize the buffers for storing raw EEG and decisions
-    eeg_buffer = np.zeros((int(fs * buffer_length), n_channels))
-    filter_state = None  # for use with the notch filter
-    decision_buffer = np.zeros((30, 1))
+    if args.online:
+        plotter_decision.fig.canvas.mpl_connect('key_press_event', on_key)
 
-    plotter_decision = BCIw.DataPlotter(30, ['Decision'])
+    # Latency of each step of the loop, and age of the newest sample used
+    # for each decision
+    latency = BCIw.LatencyMonitor(['acquisition', 'filtering', 'features',
+                                   'prediction', 'plotting', 'sample age'])
 
     # The try/except structure allows to quit the while loop by aborting the
     # script with <Ctrl-C>
     print('Press Ctrl-C in the console to break the while loop.')
 
+    if args.pipeline:
+        # The acquisition process opens its own inlet
+        inlet.close_stream()
+        pipeline = BCIpipe.Pipeline(BCIpipe.stream_selector(info), fs,
+                                    index_channel, epoch_length, shift_length,
+                                    classifier=(classifier, mu_ft, std_ft),
+                                    plan=plan)
+        pipeline.start()
+
     try:
-        while True:
+        if args.pipeline:
+            # Only visualize here, as fast as the plots can be redrawn
+            while pipeline.is_alive():
+                results = pipeline.get_results(timeout=1)
+                if not results:
+                    continue
+                for result in results:
+                    print(result['decision'])
+                    decision_buffer.update(
+                            np.reshape(result['decision'], (-1, 1)))
+                    latency.record(**result['latency'])
+
+                t_start = local_clock()
+                plotter_decision.update_plot(decision_buffer.get_data())
+                plt.pause(0.00001)
+                latency.record(plotting=local_clock() - t_start)
+
+        while not args.pipeline:
 
             """ 3.1 ACQUIRE DATA """
             # Obtain EEG data from the LSL stream
+            t_start = local_clock()
             eeg_data, timestamp = inlet.pull_chunk(
                     timeout=1, max_samples=int(shift_length * fs))
+            t_acquired = local_clock()
 
             # Only keep the channel we're interested in
             ch_data = np.array(eeg_data)[:, index_channel]
 
             # Update EEG buffer
-            eeg_buffer, filter_state = BCIw.update_buffer(
-                    eeg_buffer, ch_data, notch=True,
-                    filter_state=filter_state)
+            eeg_buffer.update(ch_data)
+            t_filtered = local_clock()
 
             """ 3.2 COMPUTE FEATURES AND CLASSIFY """
-            # Get newest samples from the buffer
-            data_epoch = BCIw.get_last_data(eeg_buffer,
-                                            epoch_length * fs)
-
-            # Compute features
-            feat_vector = BCIw.compute_feature_vector(data_epoch, fs)
-            y_hat = BCIw.test_classifier(classifier,
-                                         feat_vector.reshape(1, -1), mu_ft,
-                                         std_ft)
+            # Slide the epoch over the newest filtered samples and compute
+            # its features
+            feat_vector = band_power.update(
+                    eeg_buffer.get_last_data(ch_data.shape[0]))
+            t_features = local_clock()
+            if args.online:
+                # Learn from the labeled epochs, follow the drift of the
+                # features with all of them
+                if feedback['label'] is None:
+                    classifier.update_normalization(feat_vector)
+                else:
+                    classifier.partial_fit(feat_vector, feedback['label'])
+                y_hat = classifier.predict(feat_vector.reshape(1, -1))
+            else:
+                y_hat = evaluator.predict(feat_vector.reshape(1, -1))
+            t_decision = local_clock()
             print(y_hat)
 
-            decision_buffer, _ = BCIw.update_buffer(decision_buffer,
-                                                    np.reshape(y_hat, (-1, 1)))
+            decision_buffer.update(np.reshape(y_hat, (-1, 1)))
 
             """ 3.3 VISUALIZE THE DECISIONS """
-            plotter_decision.update_plot(decision_buffer)
+            plotter_decision.update_plot(decision_buffer.get_data())
             plt.pause(0.00001)
+            t_plotted = local_clock()
+
+            latency.record(acquisition=t_acquired - t_start,
+                           filtering=t_filtered - t_acquired,
+                           features=t_features - t_filtered,
+                           prediction=t_decision - t_features,
+                           plotting=t_plotted - t_decision)
+            if timestamp:
+                # Timestamps are in the clock of the EEG source
+                latency.record(**{'sample age': t_decision - (
+                    timestamp[-1] + eeg_time_correction)})
 
     except KeyboardInterrupt:
 
         print('Closed!')
+        print(latency.report())
+        if args.latency_log:
+            latency.dump(args.latency_log)
+
+    if args.pipeline:
+        pipeline.stop()
+        print(pipeline.report())
@@ -23,14 +23,17 @@ Methods:
     getalldata()
     parsedata(package)
     getdata(seconds, flush)
+    startstreaming(buffer_seconds, poll_interval)
+    stopstreaming()
 
 '''
 
 import socket
 import numpy as np
-import array
 import struct
 import sys
+import threading
+import time
 
 class MulesClient():
     """
@@ -58,6 +61,10 @@ class MulesClient():
         self.ip = ip
         self.port = port
         self.python2 = sys.version_info < (3,0)
+        # Serializes request/response exchanges with MuLES
+        self.lock = threading.RLock()
+        self.streaming = False
+        self.stream_thread = None
 
         # TCP/IP connection
         self.connect()
@@ -95,6 +102,7 @@ class MulesClient():
         The connection parameters are preserved, so the connection can later be reestablished
         by using the connect() method.
         """
+        self.stopstreaming()
         self.client.close()
         self.client = None
         print('Connection closed successfully')
@@ -113,10 +121,11 @@ class MulesClient():
         Arguments:
             command: the command to be sent.
         """
-        if self.python2:
-            self.client.send(command)
-        else:
-            self.client.send(bytearray(command,'ISO-8859-1'))
+        with self.lock:
+            if self.python2:
+                self.client.send(command)
+            else:
+                self.client.send(bytearray(command,'ISO-8859-1'))
 
 
     def flushdata(self):
@@ -170,28 +179,38 @@ class MulesClient():
             This gets a Message sent by MuLES an returns a byte array with the
             Message content
         """
-        n_bytes_4B = array.array('B',self.client.recv(4) )
-        n_bytes = struct.unpack('i',n_bytes_4B[::-1])[0]
-        #n_bytes equals to number of bytes to read from the connection
-        #[0] is used to get an int32 rather than turple
-        # Next while lopp secures the integrity of the package
-        package = '';
+        # 4 bytes big-endian header with the number of bytes to read
+        header = bytearray(4)
+        self._recvall(header)
+        n_bytes = struct.unpack('>i', bytes(header))[0]
 
-        while len(package) < n_bytes:
-            if self.python2:
-                package += self.client.recv(1)
-            else:
-                package += self.client.recv(1).decode("ISO-8859-1")
+        package = bytearray(n_bytes)
+        self._recvall(package)
 
-        return package
+        return bytes(package)
+
+    def _recvall(self, buffer):
+        """
+            Fills "buffer" (bytearray) with data from the connection, reading
+            as many bytes per call as available
+        """
+        view = memoryview(buffer)
+        n_read = 0
+        while n_read < len(buffer):
+            n_new = self.client.recv_into(view[n_read:])
+            if n_new == 0:
+                raise socket.error('Connection closed by MuLES')
+            n_read += n_new
 
     def getheader(self):
         """
             Request and Retrieves Header Information from MuLES
         """
         #print('Header request')
-        self.sendcommand('H')
-        return self.parseheader(self.getmessage())
+        with self.lock:
+            self.sendcommand('H')
+            package = self.getmessage()
+        return self.parseheader(package.decode('ISO-8859-1'))
 
     def parseheader(self, package):
         """
@@ -227,8 +246,10 @@ class MulesClient():
             Request and Retrieves the names of channels from MuLES
         """
         #print('Names Request')
-        self.sendcommand('N')
-        return self.getmessage().split(',')
+        with self.lock:
+            self.sendcommand('N')
+            package = self.getmessage()
+        return package.decode('ISO-8859-1').split(',')
 
 
     def getalldata(self):
@@ -239,8 +260,10 @@ class MulesClient():
             [samples, channels]
         """
         #print('Data Request')
-        self.sendcommand('R')
-        return self.parsedata(self.getmessage())
+        with self.lock:
+            self.sendcommand('R')
+            package = self.getmessage()
+        return self.parsedata(package)
 
     def parsedata(self, package):
         """
@@ -256,28 +279,12 @@ class MulesClient():
 
         n_columns = len(self.params['data format'])
         n_bytes = len(package)
-        n_samples = (n_bytes/size_element) / n_columns
-        ####mesData = np.uint8(mesData) # Convert from binary to integers (not necessary pyton)
-        if self.python2:
-            bytes_per_element = np.flipud(np.reshape(list(bytearray(package)), [size_element,-1],order='F'))
-        else:
-            bytes_per_element = np.flipud(np.reshape(list(bytearray(package, 'ISO-8859-1'), ), [size_element,-1],order='F'))
-        # Changes "package" to a list with size (n_bytes,1)
-        # Reshapes the list into a matrix bytes_per_element which has the size: (4,n_bytes/4)
-        # Flips Up-Down the matrix of size (4,n_bytes/4) to correct the swap in bytes
-
-        package_correct_order = np.uint8(np.reshape(bytes_per_element,[n_bytes,-1],order='F' ))
-        # Unrolls the matrix bytes_per_element, in "package_correct_order"
-        # that has a size (n_bytes,1)
-
-        data_format_tags = self.params['data format']*int(n_samples)
-        # Tags used to map the elements into their corresponding representation
-        package_correct_order_char = "".join(map(chr,package_correct_order))
-
-        if self.python2:
-            elements = struct.unpack(data_format_tags,package_correct_order_char)
-        else:
-            elements = struct.unpack(data_format_tags, bytearray(package_correct_order_char,'ISO-8859-1'))
+        n_samples = (n_bytes // size_element) // n_columns
+
+        data_format_tags = '>' + self.params['data format']*int(n_samples)
+        # Tags used to map the elements into their corresponding representation,
+        # MuLES sends every element in big-endian byte order
+        elements = struct.unpack(data_format_tags, package)
         # Elements are cast in their corresponding representation
         data = np.reshape(np.array(elements),[n_samples,n_columns],order='C')
         # Elements are reshap into data [n_samples, n_columns]
@@ -295,7 +302,14 @@ class MulesClient():
                      n_samples = seconds * sampling_frequency
             flush:   Boolean, if True send the command Flush before getting Data,
                      Defaul = True
+
+            When streaming (see startstreaming), the newest n_samples received
+            by the background reader are returned instead, as soon as they are
+            available, and flush is ignored.
         """
+        if self.streaming:
+            return self.getstreameddata(seconds)
+
         if flush:
             self.flushdata()
 
@@ -311,3 +325,113 @@ class MulesClient():
             data_buffer = np.delete(data_buffer, np.s_[0:new_samples], 0)
 
         return data_buffer
+
+    def startstreaming(self, buffer_seconds=30, poll_interval=0.01):
+        """
+            Start a background thread that keeps requesting data from MuLES
+            and stores it in a preallocated ring buffer, so getdata returns
+            the newest data immediately.
+
+            Argument:
+            buffer_seconds: length of the ring buffer in seconds, the longest
+                            window that getdata can return while streaming
+            poll_interval:  time in seconds to wait before a new request when
+                            MuLES had no new data
+        """
+        if self.streaming:
+            return
+
+        n_buffer = int(round(buffer_seconds * self.params['sampling frequency']))
+        n_columns = len(self.params['data format'])
+        self.ring = np.zeros((n_buffer, n_columns))
+        self.ring_pos = 0      # Row where the next sample is written
+        self.ring_count = 0    # Number of samples received since the start
+        self.ring_condition = threading.Condition()
+        self.poll_interval = poll_interval
+        self.stream_error = None
+
+        self.flushdata()
+        self.streaming = True
+        self.stream_thread = threading.Thread(target=self._stream)
+        self.stream_thread.daemon = True
+        self.stream_thread.start()
+
+    def stopstreaming(self):
+        """
+            Stop the background reader started by startstreaming
+        """
+        self.streaming = False
+        if self.stream_thread is not None:
+            self.stream_thread.join()
+            self.stream_thread = None
+
+    def _stream(self):
+        """
+            Loop of the background reader: request data and append it to the
+            ring buffer
+        """
+        try:
+            while self.streaming:
+                new_data = self.getalldata()
+                if new_data.shape[0] == 0:
+                    time.sleep(self.poll_interval)
+                    continue
+                with self.ring_condition:
+                    self._appendring(new_data)
+                    self.ring_condition.notify_all()
+        except Exception as e:
+            self.stream_error = e
+            self.streaming = False
+            with self.ring_condition:
+                self.ring_condition.notify_all()
+
+    def _appendring(self, new_data):
+        """
+            Copies new_data in the ring buffer, overwritting the oldest samples
+        """
+        n_buffer = self.ring.shape[0]
+        n_new = new_data.shape[0]
+        self.ring_count += n_new
+        if n_new > n_buffer:
+            new_data = new_data[-n_buffer:]
+            self.ring_pos = (self.ring_pos + n_new - n_buffer) % n_buffer
+            n_new = n_buffer
+
+        n_first = min(n_new, n_buffer - self.ring_pos)
+        self.ring[self.ring_pos:self.ring_pos + n_first] = new_data[:n_first]
+        self.ring[:n_new - n_first] = new_data[n_first:]
+        self.ring_pos = (self.ring_pos + n_new) % n_buffer
+
+    def getstreameddata(self, seconds, timeout=None):
+        """
+            Returns the newest seconds * sampling_frequency samples received by
+            the background reader, waiting only until that many samples have
+            been received since startstreaming was called.
+            Data returned has the shape [seconds * sampling_frequency, channels]
+
+            Argument:
+            seconds: length of the window, at most the length of the ring buffer
+            timeout: maximum time to wait in seconds, None waits indefinitely
+        """
+        n_samples = int(round(seconds * self.params['sampling frequency']))
+        n_buffer = self.ring.shape[0]
+        if n_samples > n_buffer:
+            raise ValueError('Requested %d samples, but the streaming buffer '
+                             'only holds %d' % (n_samples, n_buffer))
+
+        with self.ring_condition:
+            while self.ring_count < n_samples:
+                if not self.streaming:
+                    raise RuntimeError('Streaming stopped before enough data '
+                                       'was received: %r' % self.stream_error)
+                if not self.ring_condition.wait(timeout):
+                    raise RuntimeError('Timeout while waiting for data')
+
+            start = (self.ring_pos - n_samples) % n_buffer
+            if start + n_samples <= n_buffer:
+                data = self.ring[start:start + n_samples].copy()
+            else:
+                data = np.concatenate((self.ring[start:],
+                                       self.ring[:self.ring_pos]), axis=0)
+
+        return data
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Record an LSL stream to a memory-mapped session file."""
+import numpy as np
+from time import time
+from pylsl import StreamInlet, resolve_byprop
+from optparse import OptionParser
+
+from lsl_recording import SessionRecorder, get_stream_metadata
+
+parser = OptionParser()
+parser.add_option("-o", "--output",
+                  dest="output", type='string', default="session.bcirec",
+                  help="session file to write.")
+parser.add_option("-t", "--type",
+                  dest="type", type='string', default="EEG",
+                  help="type of the stream to record.")
+parser.add_option("-d", "--duration",
+                  dest="duration", type='float', default=None,
+                  help="recording duration in seconds, until Ctrl-C by default.")
+parser.add_option("-c", "--chunk",
+                  dest="chunk", type='int', default=65536,
+                  help="number of samples the file grows by when full.")
+
+(options, args) = parser.parse_args()
+
+print("looking for a %s stream..." % options.type)
+streams = resolve_byprop('type', options.type, timeout=2)
+
+if len(streams) == 0:
+    raise(RuntimeError("Cant find %s stream" % options.type))
+
+inlet = StreamInlet(streams[0], max_chunklen=12)
+metadata = get_stream_metadata(inlet.info())
+recorder = SessionRecorder(options.output, metadata,
+                           chunk_samples=options.chunk)
+print("Recording %s to %s, press Ctrl-C to stop" % (metadata['name'],
+                                                    options.output))
+
+start = time()
+try:
+    while options.duration is None or time() - start < options.duration:
+        samples, timestamps = inlet.pull_chunk(timeout=1.0)
+        if timestamps:
+            # One clock offset per chunk, the same for all its samples
+            timestamps = np.asarray(timestamps) + inlet.time_correction()
+            recorder.append(samples, timestamps)
+except KeyboardInterrupt:
+    pass
+
+recorder.close()
+print("Recorded %d samples" % recorder.n_samples)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Replay a session file as an LSL stream."""
+import numpy as np
+from time import sleep
+from pylsl import StreamInfo, StreamOutlet, local_clock
+from optparse import OptionParser
+
+from lsl_recording import load_session
+
+LSL_FORMATS = {'float32': 'float32', 'float64': 'double64',
+               'int32': 'int32', 'int16': 'int16', 'int8': 'int8',
+               'int64': 'int64'}
+
+parser = OptionParser()
+parser.add_option("-f", "--file",
+                  dest="filename", type='string', default="session.bcirec",
+                  help="session file to replay.")
+parser.add_option("-s", "--speed",
+                  dest="speed", type='float', default=1.,
+                  help="speed multiple, 0 to replay as fast as possible.")
+parser.add_option("-c", "--chunk",
+                  dest="chunk", type='int', default=12,
+                  help="number of samples pushed at once.")
+parser.add_option("-l", "--loop",
+                  dest="loop", action='store_true', default=False,
+                  help="replay the session in a loop.")
+
+(options, args) = parser.parse_args()
+
+metadata, data, timestamps = load_session(options.filename)
+if len(timestamps) == 0:
+    raise(RuntimeError("Empty session file"))
+
+info = StreamInfo(metadata['name'], metadata['type'],
+                  metadata['n_channels'], metadata['nominal_srate'],
+                  LSL_FORMATS[metadata['dtype']], metadata['source_id'])
+channels = info.desc().append_child("channels")
+for c in metadata['channels']:
+    channels.append_child("channel") \
+        .append_child_value("label", c['label']) \
+        .append_child_value("unit", c['unit']) \
+        .append_child_value("type", c['type'])
+outlet = StreamOutlet(info, options.chunk, 360)
+
+print("Replaying %d samples of %s at %gx, press Ctrl-C to stop"
+      % (len(timestamps), metadata['name'], options.speed))
+
+try:
+    while True:
+        start = local_clock()
+        offset = timestamps[0]
+        for i in range(0, len(timestamps), options.chunk):
+            chunk_times = np.asarray(timestamps[i:i + options.chunk]) - offset
+            if options.speed > 0:
+                chunk_times = start + chunk_times / options.speed
+                wait = chunk_times[-1] - local_clock()
+                if wait > 0:
+                    sleep(wait)
+            else:
+                chunk_times = np.full(len(chunk_times), local_clock())
+            outlet.push_chunk(np.ascontiguousarray(data[i:i + options.chunk]),
+                              chunk_times)
+        if not options.loop:
+            break
+except KeyboardInterrupt:
+    pass
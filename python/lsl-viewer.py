@@ -1,47 +1,20 @@
 #!/usr/bin/env python
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import butter, lfilter, lfilter_zi, firwin
 from time import sleep
 from pylsl import StreamInlet, resolve_byprop
 from optparse import OptionParser
 import seaborn as sns
 from threading import Thread
 
-sns.set(style="whitegrid")
+from bci_workshop_tools import RingBuffer, FilterStage
 
-parser = OptionParser()
-
-parser.add_option("-w", "--window",
-                  dest="window", type='float', default=5.,
-                  help="window lenght to display in seconds.")
-parser.add_option("-s", "--scale",
-                  dest="scale", type='float', default=100,
-                  help="scale in uV")
-parser.add_option("-r", "--refresh",
-                  dest="refresh", type='float', default=0.2,
-                  help="refresh rate in seconds.")
-parser.add_option("-f", "--figure",
-                  dest="figure", type='string', default="15x6",
-                  help="window size.")
+sns.set(style="whitegrid")
 
 filt = True
 subsample = 2
 buf = 12
 
-(options, args) = parser.parse_args()
-
-window = options.window
-scale = options.scale
-figsize = np.int16(options.figure.split('x'))
-
-print("looking for an EEG stream...")
-streams = resolve_byprop('type', 'EEG', timeout=2)
-
-if len(streams) == 0:
-    raise(RuntimeError("Cant find EEG stream"))
-print("Start aquiring data")
-
 
 class LSLViewer():
 
@@ -58,7 +31,6 @@ class LSLViewer():
         description = info.desc()
 
         self.sfreq = info.nominal_srate()
-        self.n_samples = int(self.sfreq * self.window)
         self.n_chan = info.channel_count()
 
         ch = description.child('channels').first_child()
@@ -78,14 +50,15 @@ class LSLViewer():
 
         sns.despine(left=True)
 
-        self.data = np.zeros((self.n_samples, self.n_chan))
-        self.times = np.arange(-self.window, 0, 1./self.sfreq)
-        impedances = np.std(self.data, axis=0)
+        self._init_buffers()
+        data = self.data.get_data()
+        times = self.times.get_data()[:, 0]
+        impedances = np.std(data, axis=0)
         lines = []
 
         for ii in range(self.n_chan):
-            line, = axes.plot(self.times[::subsample],
-                              self.data[::subsample, ii] - ii, lw=1)
+            line, = axes.plot(times[::subsample],
+                              data[::subsample, ii] - ii, lw=1)
             lines.append(line)
         self.lines = lines
 
@@ -102,16 +75,46 @@ class LSLViewer():
 
         self.display_every = int(0.2 / (12/self.sfreq))
 
-        # self.bf, self.af = butter(4, np.array([1, 40])/(self.sfreq/2.),
-        #                          'bandpass')
+        self.filter_stage = FilterStage(self.n_chan, self.sfreq,
+                                        [('bandpass', (1, 40), 4)])
 
-        self.bf = firwin(32, np.array([1, 40])/(self.sfreq/2.), width=0.05,
-                         pass_zero=False)
-        self.af = [1.0]
+    def _init_buffers(self, end_time=0.):
+        """Allocate the raw data, filtered data and time buffers.
 
-        zi = lfilter_zi(self.bf, self.af)
-        self.filt_state = np.tile(zi, (self.n_chan, 1)).transpose()
-        self.data_f = np.zeros((self.n_samples, self.n_chan))
+        The buffers hold one window of samples. Their timestamps start
+        "window" seconds before "end_time".
+        """
+        self.n_samples = int(self.sfreq * self.window)
+        self.data = RingBuffer(self.n_samples, self.n_chan)
+        self.data_f = RingBuffer(self.n_samples, self.n_chan)
+        # LSL timestamps need double precision whatever the data type
+        self.times = RingBuffer(self.n_samples, 1, dtype=np.float64)
+        self.times.update(end_time +
+                          np.arange(-self.n_samples, 0) / self.sfreq)
+
+    def _resize_buffers(self):
+        """Resize the buffers to the window, keeping the newest samples."""
+        n_kept = min(int(self.sfreq * self.window), self.n_samples)
+        data = self.data.get_last_data(n_kept).copy()
+        data_f = self.data_f.get_last_data(n_kept).copy()
+        times = self.times.get_last_data(n_kept).copy()
+
+        self._init_buffers(end_time=times[0, 0])
+        self.data.update(data)
+        self.data_f.update(data_f)
+        self.times.update(times)
+
+    def ingest_chunk(self, samples, timestamps):
+        """Add a chunk of samples to the buffers."""
+        if self.n_samples != int(self.sfreq * self.window):
+            self._resize_buffers()
+        if self.dejitter:
+            timestamps = np.float64(np.arange(len(timestamps)))
+            timestamps /= self.sfreq
+            timestamps += self.times.get_last_data(1)[0, 0] + 1./self.sfreq
+        self.times.update(timestamps)
+        self.data.update(samples)
+        self.data_f.update(self.filter_stage.filter(samples))
 
     def update_plot(self):
         k = 0
@@ -119,31 +122,19 @@ class LSLViewer():
             samples, timestamps = self.inlet.pull_chunk(timeout=1.0,
                                                         max_samples=12)
             if timestamps:
-                if self.dejitter:
-                    timestamps = np.float64(np.arange(len(timestamps)))
-                    timestamps /= self.sfreq
-                    timestamps += self.times[-1] + 1./self.sfreq
-                self.times = np.concatenate([self.times, timestamps])
-                self.n_samples = int(self.sfreq * self.window)
-                self.times = self.times[-self.n_samples:]
-                self.data = np.vstack([self.data, samples])
-                self.data = self.data[-self.n_samples:]
-                filt_samples, self.filt_state = lfilter(
-                    self.bf, self.af,
-                    samples,
-                    axis=0, zi=self.filt_state)
-                self.data_f = np.vstack([self.data_f, filt_samples])
-                self.data_f = self.data_f[-self.n_samples:]
+                self.ingest_chunk(samples, timestamps)
                 k += 1
                 if k == self.display_every:
 
+                    times = self.times.get_data()[:, 0]
                     if self.filt:
-                        plot_data = self.data_f
+                        plot_data = self.data_f.get_data()
                     elif not self.filt:
-                        plot_data = self.data - self.data.mean(axis=0)
+                        data = self.data.get_data()
+                        plot_data = data - data.mean(axis=0)
                     for ii in range(self.n_chan):
-                        self.lines[ii].set_xdata(self.times[::subsample] -
-                                                 self.times[-1])
+                        self.lines[ii].set_xdata(times[::subsample] -
+                                                 times[-1])
                         self.lines[ii].set_ydata(plot_data[::subsample, ii] /
                                                  self.scale - ii)
                         impedances = np.std(plot_data, axis=0)
@@ -184,10 +175,39 @@ class LSLViewer():
         self.started = False
 
 
-fig, axes = plt.subplots(1, 1, figsize=figsize, sharex=True)
-lslv = LSLViewer(streams[0], fig, axes, window, scale)
+if __name__ == "__main__":
+    parser = OptionParser()
+
+    parser.add_option("-w", "--window",
+                      dest="window", type='float', default=5.,
+                      help="window lenght to display in seconds.")
+    parser.add_option("-s", "--scale",
+                      dest="scale", type='float', default=100,
+                      help="scale in uV")
+    parser.add_option("-r", "--refresh",
+                      dest="refresh", type='float', default=0.2,
+                      help="refresh rate in seconds.")
+    parser.add_option("-f", "--figure",
+                      dest="figure", type='string', default="15x6",
+                      help="window size.")
+
+    (options, args) = parser.parse_args()
+
+    window = options.window
+    scale = options.scale
+    figsize = np.int16(options.figure.split('x'))
+
+    print("looking for an EEG stream...")
+    streams = resolve_byprop('type', 'EEG', timeout=2)
+
+    if len(streams) == 0:
+        raise(RuntimeError("Cant find EEG stream"))
+    print("Start aquiring data")
+
+    fig, axes = plt.subplots(1, 1, figsize=figsize, sharex=True)
+    lslv = LSLViewer(streams[0], fig, axes, window, scale)
 
-help_str = """
+    help_str = """
             toggle filter : d
             toogle full screen : f
             zoom out : /
@@ -195,8 +215,8 @@ help_str = """
             increase time scale : -
             decrease time scale : +
            """
-print(help_str)
-lslv.start()
+    print(help_str)
+    lslv.start()
 
-plt.show()
-lslv.stop()
+    plt.show()
+    lslv.stop()
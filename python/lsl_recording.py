@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Session recording to memory-mapped files
+
+A session file starts with a fixed-size header holding the stream metadata
+as JSON, followed by fixed-size records of one timestamp (float64) and one
+sample of every channel. The file is grown by whole chunks of records and
+written through a memory map, so recording uses a bounded amount of RAM
+whatever the length of the session.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+MAGIC = b'BCIREC01'
+HEADER_SIZE = 4096
+VERSION = 1
+
+# pylsl channel formats (cf_float32, cf_double64, cf_int32, cf_int16,
+# cf_int8, cf_int64) and their numpy equivalent
+LSL_DTYPES = {1: 'float32', 2: 'float64', 4: 'int32', 5: 'int16', 6: 'int8',
+              7: 'int64'}
+
+
+def get_stream_metadata(info):
+    """Extract the metadata of an LSL stream.
+
+    Args:
+        info (pylsl.StreamInfo): information of the stream, e.g. from
+            inlet.info()
+
+    Returns:
+        (dict): metadata to store in the session header
+    """
+    channel_format = info.channel_format()
+    if channel_format not in LSL_DTYPES:
+        raise ValueError('Unsupported channel format %s' % channel_format)
+
+    n_channels = info.channel_count()
+    channels = []
+    ch = info.desc().child('channels').first_child()
+    for i in range(n_channels):
+        if ch.empty():
+            break
+        channels.append({'label': ch.child_value('label'),
+                         'unit': ch.child_value('unit'),
+                         'type': ch.child_value('type')})
+        ch = ch.next_sibling()
+
+    return {'name': info.name(),
+            'type': info.type(),
+            'source_id': info.source_id(),
+            'n_channels': n_channels,
+            'nominal_srate': info.nominal_srate(),
+            'dtype': LSL_DTYPES[channel_format],
+            'channels': channels}
+
+
+def _record_dtype(metadata):
+    """Return the dtype of one record of the session file."""
+    return np.dtype([('timestamp', '<f8'),
+                     ('data', np.dtype(metadata['dtype']).newbyteorder('<'),
+                      (metadata['n_channels'],))])
+
+
+def _write_header(f, metadata):
+    """Write the header at the beginning of the open file "f"."""
+    header = json.dumps(metadata).encode('utf-8')
+    if len(MAGIC) + 4 + len(header) > HEADER_SIZE:
+        raise ValueError('Stream metadata too large for the session header')
+    f.seek(0)
+    f.write(MAGIC)
+    f.write(np.array(len(header), dtype='<u4').tobytes())
+    f.write(header)
+    f.write(b'\0' * (HEADER_SIZE - len(MAGIC) - 4 - len(header)))
+
+
+def _read_header(f):
+    """Read the header of the open file "f"."""
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a session file')
+    header_length = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+    metadata = json.loads(f.read(header_length).decode('utf-8'))
+    if metadata['version'] > VERSION:
+        raise ValueError('Session file version %d is not supported'
+                         % metadata['version'])
+    return metadata
+
+
+class SessionRecorder():
+    """
+    Append the samples and timestamps of a stream to a session file.
+    """
+
+    def __init__(self, filename, metadata, chunk_samples=65536):
+        """Create the session file.
+
+        Args:
+            filename (str): path of the session file, overwritten if it
+                exists
+            metadata (dict): stream metadata, see get_stream_metadata
+
+        Keyword Args:
+            chunk_samples (int): number of records the file grows by when
+                it is full
+        """
+        self.filename = filename
+        self.metadata = dict(metadata, version=VERSION, n_samples=0)
+        self.chunk_samples = int(chunk_samples)
+        self.dtype = _record_dtype(self.metadata)
+        self.n_samples = 0
+
+        self._file = open(filename, 'w+b')
+        _write_header(self._file, self.metadata)
+        self._capacity = 0
+        self._records = None
+        self._grow()
+
+    def _grow(self):
+        """Extend the file by one chunk and map it again."""
+        if self._records is not None:
+            self._records.flush()
+            self._records = None
+        self._capacity += self.chunk_samples
+        self._file.truncate(HEADER_SIZE + self._capacity * self.dtype.itemsize)
+        self._records = np.memmap(self._file, dtype=self.dtype, mode='r+',
+                                  offset=HEADER_SIZE, shape=(self._capacity,))
+
+    def append(self, samples, timestamps):
+        """Append a chunk of samples.
+
+        Args:
+            samples (list or numpy.ndarray): samples of shape [n_samples,
+                n_channels], e.g. as returned by inlet.pull_chunk
+            timestamps (list or numpy.ndarray): timestamp of every sample
+        """
+        n_new = len(timestamps)
+        if n_new == 0:
+            return
+
+        start = 0
+        while start < n_new:
+            if self.n_samples == self._capacity:
+                self._flush_header()
+                self._grow()
+            n_copy = min(n_new - start, self._capacity - self.n_samples)
+            records = self._records[self.n_samples:self.n_samples + n_copy]
+            records['timestamp'] = timestamps[start:start + n_copy]
+            records['data'] = samples[start:start + n_copy]
+            self.n_samples += n_copy
+            start += n_copy
+
+    def _flush_header(self):
+        """Record the number of samples written in the header."""
+        self.metadata['n_samples'] = self.n_samples
+        _write_header(self._file, self.metadata)
+
+    def flush(self):
+        """Write the samples and the header to disk."""
+        self._records.flush()
+        self._flush_header()
+        self._file.flush()
+
+    def close(self):
+        """Flush and shrink the file to the samples actually recorded."""
+        self.flush()
+        self._records = None
+        self._file.truncate(HEADER_SIZE + self.n_samples * self.dtype.itemsize)
+        self._file.close()
+
+
+def load_session(filename):
+    """Open a session file without reading it in memory.
+
+    Args:
+        filename (str): path of the session file
+
+    Returns:
+        (dict): stream metadata
+        (numpy.ndarray): read-only memory-mapped samples [n_samples,
+            n_channels]
+        (numpy.ndarray): read-only memory-mapped timestamps [n_samples]
+    """
+    with open(filename, 'rb') as f:
+        metadata = _read_header(f)
+
+    dtype = _record_dtype(metadata)
+    # Use the size of the file in case the recorder did not close properly
+    n_samples = (os.path.getsize(filename) - HEADER_SIZE) // dtype.itemsize
+    n_samples = max(n_samples, metadata['n_samples'])
+    if n_samples == 0:
+        return (metadata, np.zeros((0, metadata['n_channels']),
+                                   dtype=metadata['dtype']), np.zeros(0))
+
+    records = np.memmap(filename, dtype=dtype, mode='r', offset=HEADER_SIZE,
+                        shape=(n_samples,))
+    if n_samples > metadata['n_samples']:
+        # Unclosed file, skip the preallocated records never written to
+        n_samples = metadata['n_samples'] + int(np.count_nonzero(
+                records['timestamp'][metadata['n_samples']:]))
+        records = records[:n_samples]
+
+    return metadata, records['data'], records['timestamp']
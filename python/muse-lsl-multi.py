@@ -0,0 +1,81 @@
+import asyncio
+import signal
+from muse.manager import MuseManager
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-a", "--addresses",
+                  dest="addresses", type='string', default=None,
+                  help="comma separated device mac adresses.")
+parser.add_option("-n", "--names",
+                  dest="names", type='string', default=None,
+                  help="comma separated names of the devices.")
+parser.add_option("-m", "--max-devices",
+                  dest="max_devices", type='int', default=None,
+                  help="maximum number of devices to connect to.")
+parser.add_option("-b", "--backend",
+                  dest="backend", type='string', default="auto",
+                  help="pygatt backend to use. can be auto, gatt, bgapi or sim")
+parser.add_option("-i", "--interface",
+                  dest="interface", type='string', default=None,
+                  help="The interface to use, 'hci0' for gatt or a com port for bgapi")
+parser.add_option("-c", "--chunk-frames",
+                  dest="chunk_frames", type='int', default=1,
+                  help="number of Muse frames (12 samples each) pushed to LSL at once.")
+parser.add_option("-l", "--max-latency",
+                  dest="max_latency", type='float', default=None,
+                  help="push the frames accumulated so far once the oldest one is older than this (in seconds).")
+parser.add_option("-g", "--gap-policy",
+                  dest="gap_policy", type='string', default="zero",
+                  help="what to do with lost packets. can be drop, zero or interpolate")
+parser.add_option("--sim-devices",
+                  dest="sim_devices", type='int', default=1,
+                  help="number of headsets found by the sim backend.")
+parser.add_option("--sim-rate",
+                  dest="sim_rate", type='float', default=1.,
+                  help="speed of the sim backend as a multiple of 256 Hz, 0 for max speed.")
+parser.add_option("-r", "--report",
+                  dest="report", type='float', default=5.,
+                  help="print the health of the devices every that many seconds.")
+
+(options, args) = parser.parse_args()
+
+manager = MuseManager(
+    backend=options.backend, interface=options.interface,
+    names=options.names.split(',') if options.names else None,
+    addresses=options.addresses.split(',') if options.addresses else None,
+    max_devices=options.max_devices, chunk_frames=options.chunk_frames,
+    max_latency=options.max_latency, gap_policy=options.gap_policy,
+    sim_options={'rate': options.sim_rate,
+                 'n_devices': options.sim_devices})
+
+
+async def report():
+    while True:
+        await asyncio.sleep(options.report)
+        for address, health in sorted(manager.get_health().items()):
+            print('%s %-12s %-12s %6.1f frames/s %s' % (
+                address, health['name'], health['state'],
+                health['frames/s'], health['error'] or ''))
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    try:
+        # Let run() stop and disconnect every device on Ctrl-C
+        loop.add_signal_handler(signal.SIGINT, manager.stop)
+    except NotImplementedError:  # Windows
+        pass
+    reporter = asyncio.ensure_future(report())
+    try:
+        await manager.run()
+    finally:
+        reporter.cancel()
+
+print('Scanning, press Ctrl-C to stop')
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    # Without the signal handler, run() is cancelled and still cleans up
+    pass
+print('Disconnected')
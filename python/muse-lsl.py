@@ -1,6 +1,7 @@
 from muse import Muse
+from muse.stream import create_outlet, ChunkPublisher
 from time import sleep
-from pylsl import StreamInfo, StreamOutlet, local_clock
+from pylsl import local_clock
 from optparse import OptionParser
 
 parser = OptionParser()
@@ -12,46 +13,66 @@ parser.add_option("-n", "--name",
                   help="name of the device.")
 parser.add_option("-b", "--backend",
                   dest="backend", type='string', default="auto",
-                  help="pygatt backend to use. can be auto, gatt or bgapi")
+                  help="pygatt backend to use. can be auto, gatt, bgapi or sim")
 parser.add_option("-i", "--interface",
                   dest="interface", type='string', default=None,
                   help="The interface to use, 'hci0' for gatt or a com port for bgapi")
+parser.add_option("-c", "--chunk-frames",
+                  dest="chunk_frames", type='int', default=1,
+                  help="number of Muse frames (12 samples each) pushed to LSL at once.")
+parser.add_option("-l", "--max-latency",
+                  dest="max_latency", type='float', default=None,
+                  help="push the frames accumulated so far once the oldest one is older than this (in seconds).")
+parser.add_option("-g", "--gap-policy",
+                  dest="gap_policy", type='string', default="zero",
+                  help="what to do with lost packets. can be drop, zero or interpolate")
+parser.add_option("--sim-rate",
+                  dest="sim_rate", type='float', default=1.,
+                  help="speed of the sim backend as a multiple of 256 Hz, 0 for max speed.")
+parser.add_option("--sim-loss",
+                  dest="sim_loss", type='float', default=0.,
+                  help="probability of losing a packet with the sim backend.")
+parser.add_option("--sim-reorder",
+                  dest="sim_reorder", type='float', default=0.,
+                  help="probability of reordering a packet with the sim backend.")
+parser.add_option("-s", "--stats",
+                  dest="stats", action='store_true', default=False,
+                  help="print the frame rate and packet counters every second.")
 
 (options, args) = parser.parse_args()
 
-info = info = StreamInfo('Muse', 'EEG', 5, 256, 'float32',
-                         'Muse%s' % options.address)
+outlet = create_outlet(options.address,
+                       chunk_size=12 * options.chunk_frames)
 
-info.desc().append_child_value("manufacturer", "Muse")
-channels = info.desc().append_child("channels")
-
-for c in ['TP9', 'AF7', 'AF8', 'TP10', 'Right AUX']:
-    channels.append_child("channel") \
-        .append_child_value("label", c) \
-        .append_child_value("unit", "microvolts") \
-        .append_child_value("type", "EEG")
-outlet = StreamOutlet(info, 12, 360)
-
-
-def process(data, timestamps):
-    for ii in range(12):
-        outlet.push_sample(data[:, ii], timestamps[ii])
+publisher = ChunkPublisher(outlet, options.chunk_frames, options.max_latency)
+process = publisher.process
 
 muse = Muse(address=options.address, callback=process,
             backend=options.backend, time_func=local_clock,
-            interface=options.interface, name=options.name)
+            interface=options.interface, name=options.name,
+            gap_policy=options.gap_policy,
+            sim_options={'rate': options.sim_rate, 'loss': options.sim_loss,
+                         'reorder': options.sim_reorder})
 
 muse.connect()
 print('Connected')
 muse.start()
 print('Streaming')
 
+last_frames = 0
 while 1:
     try:
         sleep(1)
+        if options.stats:
+            stats = muse.get_packet_stats()
+            print('%d frames/s %s' % (stats['emitted frames'] - last_frames,
+                                      stats))
+            last_frames = stats['emitted frames']
     except:
         break
 
 muse.stop()
 muse.disconnect()
+# No notification can arrive anymore, push the last frames
+publisher.flush()
 print('Disonnected')
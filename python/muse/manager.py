@@ -0,0 +1,217 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from .muse import Muse, create_adapter
+
+
+class MuseManager():
+    """Acquire from many Muse headsets concurrently in a single process.
+
+    The manager scans once, connects to every headset found in parallel and
+    gives each of them its own LSL outlet. The blocking pygatt calls (scan,
+    connect, start, stop) run in a thread pool so the asyncio event loop
+    only schedules them and monitors the devices. Notifications are decoded
+    and published in the threads of the backend, never on the event loop.
+    """
+
+    def __init__(self, backend='auto', interface=None, names=None,
+                 addresses=None, max_devices=None, scan_timeout=10.5,
+                 chunk_frames=1, max_latency=None, gap_policy='zero',
+                 sim_options=None, time_func=None, monitor_interval=1.,
+                 stall_timeout=2.):
+        """Initialize
+
+        Args:
+            backend (str): pygatt backend to use. can be auto, gatt, bgapi
+                or sim
+            interface (str): 'hci0' for gatt or a com port for bgapi
+            names (list): only connect to the devices with these names
+            addresses (list): only connect to the devices with these
+                addresses. Skips the scan if names is not given.
+            max_devices (int): connect to at most that many devices
+            scan_timeout (float): duration of the scan in seconds
+            chunk_frames (int): number of frames pushed to LSL at once
+            max_latency (float): push the frames accumulated so far once
+                the oldest one is older than this (in seconds)
+            gap_policy (str): see Muse
+            sim_options (dict): keyword arguments of the sim backend
+            time_func (function): clock used to timestamp the samples.
+                Defaults to pylsl.local_clock, the clock of the outlets.
+            monitor_interval (float): seconds between two health updates
+            stall_timeout (float): a streaming device that sent no frame
+                for that many seconds is reported as stalled
+        """
+        self.backend = Muse(backend=backend).backend
+        self.interface = interface
+        self.names = names
+        self.addresses = addresses
+        self.max_devices = max_devices
+        self.scan_timeout = scan_timeout
+        self.chunk_frames = chunk_frames
+        self.max_latency = max_latency
+        self.gap_policy = gap_policy
+        self.sim_options = sim_options or {}
+        if time_func is None:
+            from pylsl import local_clock
+            time_func = local_clock
+        self.time_func = time_func
+        self.monitor_interval = monitor_interval
+        self.stall_timeout = stall_timeout
+
+        # gatttool handles a single connection, other backends can share
+        # one adapter between all the devices
+        self.shared_adapter = self.backend != 'gatt'
+        self.adapter = None
+        self.devices = {}
+        self.executor = None
+        self.stopped = None
+
+    async def _call(self, func, *args):
+        """Run a blocking call in the thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def discover(self):
+        """Scan once and return the devices to connect to.
+
+        Returns:
+            (list): dicts with the name and address of the devices
+        """
+        if self.addresses and not self.names:
+            found = [{'name': 'Muse', 'address': address}
+                     for address in self.addresses]
+        else:
+            found = await self._call(self.adapter.scan, self.scan_timeout)
+
+        devices = []
+        for device in found:
+            name = device.get('name') or ''
+            if self.names and name not in self.names:
+                continue
+            if self.addresses and device['address'] not in self.addresses:
+                continue
+            if not self.names and not self.addresses and 'Muse' not in name:
+                continue
+            devices.append(device)
+
+        return devices[:self.max_devices]
+
+    async def _start_device(self, device):
+        """Connect to one device, create its outlet and start streaming."""
+        from .stream import create_outlet, ChunkPublisher
+
+        address = device['address']
+        outlet = create_outlet(address, name=device.get('name') or 'Muse',
+                               chunk_size=12 * self.chunk_frames)
+        publisher = ChunkPublisher(outlet, self.chunk_frames,
+                                   self.max_latency)
+        muse = Muse(address=address, callback=publisher.process,
+                    backend=self.backend, interface=self.interface,
+                    time_func=self.time_func, gap_policy=self.gap_policy,
+                    sim_options=self.sim_options)
+        health = {'name': device.get('name'), 'address': address,
+                  'state': 'connecting', 'error': None, 'frames/s': 0.,
+                  'last frame': None}
+        self.devices[address] = {'muse': muse, 'publisher': publisher,
+                                 'health': health, 'frames': 0}
+        try:
+            if self.shared_adapter:
+                adapter = self.adapter
+            else:
+                # Do not reset the interface, it would drop the connections
+                # of the other devices
+                adapter = create_adapter(self.backend, self.interface)
+                self.devices[address]['adapter'] = adapter
+                await self._call(adapter.start, False)
+            await self._call(muse.connect, None, 'auto', adapter)
+            await self._call(muse.start)
+            health['state'] = 'streaming'
+            health['last frame'] = time()
+        except Exception as e:
+            health['state'] = 'error'
+            health['error'] = repr(e)
+
+    async def _stop_device(self, entry):
+        """Stop streaming and disconnect from one device."""
+        muse = entry['muse']
+        if entry['health']['state'] in ['error', 'connecting']:
+            return
+        try:
+            await self._call(muse.stop)
+            await self._call(muse.disconnect)
+            if 'adapter' in entry:
+                await self._call(entry['adapter'].stop)
+            # No notification can arrive anymore, push the last frames
+            entry['publisher'].flush()
+            entry['health']['state'] = 'disconnected'
+        except Exception as e:
+            entry['health']['state'] = 'error'
+            entry['health']['error'] = repr(e)
+
+    def _update_health(self, elapsed):
+        """Update the frame rate and state of every device."""
+        now = time()
+        for entry in self.devices.values():
+            health = entry['health']
+            if health['state'] not in ['streaming', 'stalled']:
+                continue
+            stats = entry['muse'].get_packet_stats()
+            new_frames = stats['emitted frames'] - entry['frames']
+            entry['frames'] = stats['emitted frames']
+            health['frames/s'] = new_frames / elapsed
+            health.update(stats)
+            if new_frames:
+                health['last frame'] = now
+            if now - health['last frame'] > self.stall_timeout:
+                health['state'] = 'stalled'
+            else:
+                health['state'] = 'streaming'
+
+    def get_health(self):
+        """Return the health status of every device, by address."""
+        return dict((address, dict(entry['health']))
+                    for address, entry in self.devices.items())
+
+    async def run(self, duration=None):
+        """Discover, connect and stream until stop() is called.
+
+        Args:
+            duration (float): stop after that many seconds, never by default
+        """
+        self.stopped = asyncio.Event()
+        if self.shared_adapter:
+            self.adapter = create_adapter(self.backend, self.interface,
+                                          self.sim_options)
+        else:
+            # only used to scan
+            self.adapter = create_adapter(self.backend, self.interface)
+        self.executor = ThreadPoolExecutor(max_workers=32)
+        try:
+            await self._call(self.adapter.start)
+            devices = await self.discover()
+            await asyncio.gather(*[self._start_device(device)
+                                   for device in devices])
+
+            start = last = time()
+            while not self.stopped.is_set():
+                try:
+                    await asyncio.wait_for(self.stopped.wait(),
+                                           self.monitor_interval)
+                except asyncio.TimeoutError:
+                    pass
+                now = time()
+                self._update_health(now - last)
+                last = now
+                if duration is not None and now - start >= duration:
+                    break
+        finally:
+            await asyncio.gather(*[self._stop_device(entry)
+                                   for entry in self.devices.values()])
+            await self._call(self.adapter.stop)
+            self.executor.shutdown()
+
+    def stop(self):
+        """Make run() return, from the event loop."""
+        if self.stopped is not None:
+            self.stopped.set()
@@ -1,17 +1,142 @@
-import bitstring
-import pygatt
 import numpy as np
 from time import time, sleep
 from sys import platform
 
 
+EEG_PACKET_SIZE = 20
+EEG_SAMPLES_PER_PACKET = 12
+# 12 bits on a 2 mVpp range
+EEG_SCALE = 0.48828125
+EEG_CHANNELS = 5
+EEG_SFREQ = 256.
+GAP_POLICIES = ['drop', 'zero', 'interpolate']
+# Number of frames held back at most by the interpolate policy
+MAX_PENDING_FRAMES = 16
+
+
+# Right shift of every sample of a packet payload read as one integer
+_EEG_SHIFTS = tuple(range(12 * (EEG_SAMPLES_PER_PACKET - 1), -1, -12))
+
+
+def unpack_eeg_packet(packet):
+    """Decode a single eeg packet.
+
+    Same encoding as unpack_eeg_packets. For one packet, reading the
+    payload as one big integer and shifting it out is several times faster
+    than going through NumPy, so this is used on every notification.
+
+    Args:
+        packet (bytes or bytearray): one packet of 20 bytes
+
+    Returns:
+        (int): packet counter
+        (list): the 12 samples in microvolts
+    """
+    payload = int.from_bytes(packet[2:EEG_PACKET_SIZE], 'big')
+    data = [EEG_SCALE * (((payload >> shift) & 0xFFF) - 2048)
+            for shift in _EEG_SHIFTS]
+    return (packet[0] << 8) | packet[1], data
+
+
+def unpack_eeg_packets(packets):
+    """Decode a block of eeg packets at once, e.g. for replays.
+
+    Each packet is encoded with a 16bit big-endian counter followed by 12
+    time samples with a 12 bit resolution, i.e. 20 bytes per packet. Every
+    3 bytes of the payload hold 2 samples, so the samples are recovered with
+    shifts and masks on the whole block instead of bit-level parsing.
+
+    Args:
+        packets (bytes, bytearray or list): one packet, several packets
+            concatenated, or a list of packets
+
+    Returns:
+        (numpy.ndarray): packet counters of shape [n_packets]
+        (numpy.ndarray): samples in microvolts of shape [n_packets, 12]
+    """
+    if isinstance(packets, (list, tuple)):
+        packets = b''.join(bytes(p) for p in packets)
+    raw = np.frombuffer(packets, dtype=np.uint8).reshape(-1, EEG_PACKET_SIZE)
+
+    tm = (raw[:, 0].astype(np.int64) << 8) | raw[:, 1]
+
+    triplets = raw[:, 2:].reshape(-1, EEG_SAMPLES_PER_PACKET // 2, 3)
+    triplets = triplets.astype(np.int64)
+    samples = np.empty((raw.shape[0], EEG_SAMPLES_PER_PACKET // 2, 2),
+                       dtype=np.int64)
+    samples[:, :, 0] = (triplets[:, :, 0] << 4) | (triplets[:, :, 1] >> 4)
+    samples[:, :, 1] = ((triplets[:, :, 1] & 0xF) << 8) | triplets[:, :, 2]
+    samples = samples.reshape(-1, EEG_SAMPLES_PER_PACKET)
+
+    data = EEG_SCALE * (samples - 2048)
+    return tm, data
+
+
+def pack_eeg_packets(tm, samples):
+    """Encode eeg packets, the inverse of unpack_eeg_packets.
+
+    Args:
+        tm (numpy.ndarray): packet counters of shape [n_packets]
+        samples (numpy.ndarray): raw 12 bit samples (0 to 4095) of shape
+            [n_packets, 12]
+
+    Returns:
+        (bytes): the packets concatenated, 20 bytes per packet
+    """
+    tm = np.asarray(tm, dtype=np.int64).reshape(-1)
+    samples = np.asarray(samples, dtype=np.int64).reshape(
+            -1, EEG_SAMPLES_PER_PACKET // 2, 2)
+
+    raw = np.empty((len(tm), EEG_PACKET_SIZE), dtype=np.uint8)
+    raw[:, 0] = (tm >> 8) & 0xFF
+    raw[:, 1] = tm & 0xFF
+    triplets = raw[:, 2:].reshape(-1, EEG_SAMPLES_PER_PACKET // 2, 3)
+    triplets[:, :, 0] = samples[:, :, 0] >> 4
+    triplets[:, :, 1] = ((samples[:, :, 0] & 0xF) << 4) | \
+        (samples[:, :, 1] >> 8)
+    triplets[:, :, 2] = samples[:, :, 1] & 0xFF
+    raw[:, 2:] = triplets.reshape(-1, EEG_PACKET_SIZE - 2)
+
+    return raw.tobytes()
+
+
+def create_adapter(backend, interface=None, sim_options=None):
+    """Create a backend to scan and connect to devices.
+
+    Args:
+        backend (str): 'gatt', 'bgapi' or 'sim'
+        interface (str): 'hci0' for gatt or a com port for bgapi
+        sim_options (dict): keyword arguments of the sim backend
+
+    Returns:
+        the adapter, not started yet
+    """
+    if backend == 'sim':
+        from .sim import SimulatedBackend
+        return SimulatedBackend(**(sim_options or {}))
+
+    import pygatt
+    if backend == 'gatt':
+        return pygatt.GATTToolBackend(interface or 'hci0')
+    return pygatt.BGAPIBackend(serial_port=interface)
+
+
 class Muse():
     """Muse 2016 headband"""
 
     def __init__(self, address=None, callback=None, eeg=True, accelero=False,
                  giro=False, backend='auto', interface=None, time_func=time,
-                 name=None):
-        """Initialize"""
+                 name=None, gap_policy='zero', sim_options=None):
+        """Initialize
+
+        gap_policy tells what to do with frames that have missing channels
+        or that were lost altogether: 'drop' them, fill them with zeros
+        ('zero'), or fill them by linear interpolation ('interpolate'), in
+        which case frames are held back until the next complete frame.
+
+        backend='sim' replaces the headset with a simulated device, see
+        muse.sim.SimulatedBackend, configured by the sim_options dict.
+        """
         self.address = address
         self.name = name
         self.callback = callback
@@ -20,8 +145,15 @@ class Muse():
         self.giro = giro
         self.interface = interface
         self.time_func = time_func
+        self.sim_options = sim_options or {}
+        self.data = None
 
-        if backend in ['auto', 'gatt', 'bgapi']:
+        if gap_policy not in GAP_POLICIES:
+            raise(ValueError('Gap policy must be drop, zero or interpolate'))
+        self.gap_policy = gap_policy
+        self.reset_packet_stats()
+
+        if backend in ['auto', 'gatt', 'bgapi', 'sim']:
             if backend == 'auto':
                 if platform == "linux" or platform == "linux2":
                     self.backend = 'gatt'
@@ -30,18 +162,24 @@ class Muse():
             else:
                 self.backend = backend
         else:
-            raise(ValueError('Backend must be auto, gatt or bgapi'))
+            raise(ValueError('Backend must be auto, gatt, bgapi or sim'))
 
-    def connect(self, interface=None, backend='auto'):
-        """Connect to the device"""
+    def connect(self, interface=None, backend='auto', adapter=None):
+        """Connect to the device
 
-        if self.backend == 'gatt':
-            self.interface = self.interface or 'hci0'
-            self.adapter = pygatt.GATTToolBackend(self.interface)
-        else:
-            self.adapter = pygatt.BGAPIBackend(serial_port=self.interface)
+        adapter is an already started backend shared with other devices.
+        It is left running by disconnect.
+        """
 
-        self.adapter.start()
+        self.own_adapter = adapter is None
+        if adapter is not None:
+            self.adapter = adapter
+        else:
+            if self.backend == 'gatt':
+                self.interface = self.interface or 'hci0'
+            self.adapter = create_adapter(self.backend, self.interface,
+                                          self.sim_options)
+            self.adapter.start()
 
         if self.address is None:
             address = self.find_muse_address(self.name)
@@ -84,7 +222,11 @@ class Muse():
     def start(self):
         """Start streaming."""
         self._init_sample()
-        self.last_tm = 0
+        self.last_tm = [-1] * EEG_CHANNELS
+        self.frame_tm = None
+        self.last_frame_tm = None
+        self.last_sample = None
+        self.pending = []
         self.device.char_write_handle(0x000e, [0x02, 0x64, 0x0a], False)
 
     def stop(self):
@@ -94,7 +236,8 @@ class Muse():
     def disconnect(self):
         """disconnect."""
         self.device.disconnect()
-        self.adapter.stop()
+        if self.own_adapter:
+            self.adapter.stop()
 
     def _subscribe_eeg(self):
         """subscribe to eeg stream."""
@@ -115,43 +258,171 @@ class Muse():
         Each packet is encoded with a 16bit timestamp followed by 12 time
         samples with a 12 bit resolution.
         """
-        aa = bitstring.Bits(bytes=packet)
-        pattern = "uint:16,uint:12,uint:12,uint:12,uint:12,uint:12,uint:12, \
-                   uint:12,uint:12,uint:12,uint:12,uint:12,uint:12"
-        res = aa.unpack(pattern)
-        timestamp = res[0]
-        data = res[1:]
-        # 12 bits on a 2 mVpp range
-        data = 0.48828125 * (np.array(data) - 2048)
-        return timestamp, data
+        return unpack_eeg_packet(packet)
 
     def _init_sample(self):
-        """initialize array to store the samples"""
-        self.timestamps = np.zeros(5)
-        self.data = np.zeros((5, 12))
+        """initialize array to store the samples
+
+        The arrays are allocated once and cleared in place afterwards, so the
+        callback must copy the data if it keeps it past its own return.
+        """
+        if getattr(self, 'data', None) is None:
+            self.timestamps = np.zeros(EEG_CHANNELS)
+            self.data = np.zeros((EEG_CHANNELS, EEG_SAMPLES_PER_PACKET))
+            self.received = np.zeros(EEG_CHANNELS, dtype=bool)
+        else:
+            self.timestamps.fill(0)
+            self.data.fill(0)
+            self.received.fill(False)
+
+    def reset_packet_stats(self):
+        """Reset the packet counters."""
+        self.lost_packets = 0
+        self.late_packets = 0
+        self.duplicate_packets = 0
+        self.dropped_frames = 0
+        self.filled_frames = 0
+        self.emitted_frames = 0
+
+    def get_packet_stats(self):
+        """Return a snapshot of the packet counters.
+
+        The counters are only written by the receiving thread, so they can
+        be polled from any other thread without locking.
+        """
+        return {'lost packets': self.lost_packets,
+                'late packets': self.late_packets,
+                'duplicate packets': self.duplicate_packets,
+                'dropped frames': self.dropped_frames,
+                'filled frames': self.filled_frames,
+                'emitted frames': self.emitted_frames}
 
     def _handle_eeg(self, handle, data):
         """Calback for receiving a sample.
 
         sample are received in this oder : 44, 41, 38, 32, 35
-        wait until we get 35 and call the data callback
+        The five packets of a frame share the same 16 bit counter. The frame
+        is complete when the five channels have been received, or when a
+        packet of a newer frame arrives. Counters are compared modulo 2**16
+        to handle wraparound.
         """
         timestamp = self.time_func()
         index = int((handle - 32) / 3)
         tm, d = self._unpack_eeg_channel(data)
 
-        if self.last_tm == 0:
-            self.last_tm = tm - 1
+        # Sequence tracking on this channel
+        if self.last_tm[index] >= 0:
+            diff = (tm - self.last_tm[index]) & 0xFFFF
+            if diff == 0:
+                self.duplicate_packets += 1
+                return
+            if diff >= 0x8000:
+                self.late_packets += 1
+                return
+            self.lost_packets += diff - 1
+        self.last_tm[index] = tm
+
+        if self.frame_tm is not None and tm != self.frame_tm:
+            if (tm - self.frame_tm) & 0xFFFF >= 0x8000:
+                # belongs to a frame that was already finished
+                self.late_packets += 1
+                return
+            self._finish_frame()
+
+        if self.frame_tm is None:
+            self.frame_tm = tm
 
         self.data[index] = d
         self.timestamps[index] = timestamp
-        # last data received
-        if handle == 35:
-            if tm != self.last_tm + 1:
-                print("missing sample %d : %d" % (tm, self.last_tm))
-            self.last_tm = tm
-            # affect as timestamps the first timestamps - 12 sample
-            timestamps = np.arange(-12, 0) / 256.
-            timestamps += np.min(self.timestamps[self.timestamps != 0])
-            self.callback(self.data, timestamps)
-            self._init_sample()
+        self.received[index] = True
+
+        if self.received.all():
+            self._finish_frame()
+
+    def _finish_frame(self):
+        """Apply the gap policy to the frame being assembled and emit it."""
+        # affect as timestamps the first timestamps - 12 sample
+        timestamps = np.arange(-EEG_SAMPLES_PER_PACKET, 0) / EEG_SFREQ
+        timestamps += np.min(self.timestamps[self.received])
+
+        n_lost = 0
+        if self.last_frame_tm is not None:
+            n_lost = ((self.frame_tm - self.last_frame_tm) & 0xFFFF) - 1
+        self.last_frame_tm = self.frame_tm
+        self.frame_tm = None
+        complete = self.received.all()
+
+        if self.gap_policy == 'drop':
+            if complete:
+                self._emit(self.data, timestamps)
+            else:
+                self.dropped_frames += 1
+            self.dropped_frames += n_lost
+
+        elif self.gap_policy == 'zero':
+            for i_lost in range(min(n_lost, MAX_PENDING_FRAMES), 0, -1):
+                self.filled_frames += 1
+                self._emit(np.zeros_like(self.data), timestamps -
+                           i_lost * EEG_SAMPLES_PER_PACKET / EEG_SFREQ)
+            self.dropped_frames += max(n_lost - MAX_PENDING_FRAMES, 0)
+            if not complete:
+                self.filled_frames += 1
+            self._emit(self.data, timestamps)
+
+        else:
+            if n_lost > MAX_PENDING_FRAMES:
+                # too long a gap, start over from this frame
+                self._flush_pending()
+                self.dropped_frames += n_lost
+                n_lost = 0
+            for i_lost in range(n_lost, 0, -1):
+                self.pending.append(
+                        (np.zeros_like(self.data),
+                         np.zeros(EEG_CHANNELS, dtype=bool),
+                         timestamps -
+                         i_lost * EEG_SAMPLES_PER_PACKET / EEG_SFREQ))
+            self.pending.append((self.data.copy(), self.received.copy(),
+                                 timestamps))
+            if complete or len(self.pending) > MAX_PENDING_FRAMES:
+                self._flush_pending()
+
+        self._init_sample()
+
+    def _flush_pending(self):
+        """Interpolate the missing channels of the pending frames and emit
+        them."""
+        if not self.pending:
+            return
+        data = np.concatenate([frame[0] for frame in self.pending], axis=1)
+        mask = np.repeat(np.array([frame[1] for frame in self.pending]).T,
+                         EEG_SAMPLES_PER_PACKET, axis=1)
+
+        n_samples = data.shape[1]
+        idx = np.arange(n_samples)
+        for i_ch in range(EEG_CHANNELS):
+            known = mask[i_ch]
+            if known.all():
+                continue
+            known_idx = idx[known]
+            known_val = data[i_ch, known]
+            if self.last_sample is not None:
+                known_idx = np.concatenate(([-1], known_idx))
+                known_val = np.concatenate(([self.last_sample[i_ch]],
+                                            known_val))
+            if len(known_idx):
+                data[i_ch, ~known] = np.interp(idx[~known], known_idx,
+                                               known_val)
+
+        for i_frame, (frame, received, timestamps) in enumerate(self.pending):
+            if not received.all():
+                self.filled_frames += 1
+            start = i_frame * EEG_SAMPLES_PER_PACKET
+            self._emit(data[:, start:start + EEG_SAMPLES_PER_PACKET],
+                       timestamps)
+        self.pending = []
+
+    def _emit(self, data, timestamps):
+        """Call the data callback."""
+        self.last_sample = data[:, -1].copy()
+        self.emitted_frames += 1
+        self.callback(data, timestamps)
@@ -0,0 +1,165 @@
+import numpy as np
+from threading import Thread, Event
+from time import time, sleep
+
+from .muse import pack_eeg_packets, EEG_SAMPLES_PER_PACKET
+
+
+# Characteristic of each eeg channel and the handle of its notifications
+EEG_HANDLES = {'273e0003-4c4d-454d-96be-f03bac821358': 32,
+               '273e0004-4c4d-454d-96be-f03bac821358': 35,
+               '273e0005-4c4d-454d-96be-f03bac821358': 38,
+               '273e0006-4c4d-454d-96be-f03bac821358': 41,
+               '273e0007-4c4d-454d-96be-f03bac821358': 44}
+# Order in which the headset sends the packets of a frame
+EEG_ORDER = [44, 41, 38, 32, 35]
+SIM_NAME = 'Muse-SIM'
+SIM_ADDRESS = '00:55:DA:B0:00:00'
+
+
+class SimulatedBackend():
+    """Stand-in for a pygatt backend, with one or more simulated Muse.
+
+    Each device sends correctly encoded notifications on the five eeg
+    handles once streaming is started, from its own thread like pygatt
+    does. Frames can be sent faster than real time or as fast as possible,
+    and packets can be lost or reordered on purpose.
+    """
+
+    def __init__(self, rate=1., loss=0., reorder=0., n_frames=None,
+                 seed=None, n_devices=1):
+        """Configure the simulated device.
+
+        Args:
+            rate (float): speed as a multiple of the real 256 Hz sampling
+                rate, or 0 (or None) to send frames as fast as possible
+            loss (float): probability of losing each packet
+            reorder (float): probability of swapping each packet with the
+                next one
+            n_frames (int): stop after that many frames, never by default
+            seed (int): seed of the random generator
+            n_devices (int): number of simulated headsets found by scan
+        """
+        self.rate = rate
+        self.loss = loss
+        self.reorder = reorder
+        self.n_frames = n_frames
+        self.seed = seed
+        self.n_devices = n_devices
+        self.devices = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        for device in self.devices:
+            device.disconnect()
+        self.devices = []
+
+    def scan(self, timeout=10.5):
+        if self.n_devices == 1:
+            return [{'name': SIM_NAME, 'address': SIM_ADDRESS}]
+        return [{'name': '%s-%d' % (SIM_NAME, i),
+                 'address': SIM_ADDRESS[:-2] + '%02X' % i}
+                for i in range(self.n_devices)]
+
+    def connect(self, address):
+        seed = None
+        if self.seed is not None:
+            seed = self.seed + len(self.devices)
+        device = SimulatedDevice(self.rate, self.loss, self.reorder,
+                                 self.n_frames, seed)
+        self.devices.append(device)
+        return device
+
+
+class SimulatedDevice():
+    """Simulated Muse, returned by SimulatedBackend.connect."""
+
+    def __init__(self, rate, loss, reorder, n_frames, seed):
+        self.rate = rate
+        self.loss = loss
+        self.reorder = reorder
+        self.n_frames = n_frames
+        self.rng = np.random.RandomState(seed)
+        self.callbacks = {}
+        self.frames_sent = 0
+        self.packets_lost = 0
+        self.thread = None
+        self.streaming = Event()
+
+    def subscribe(self, uuid, callback=None):
+        self.callbacks[EEG_HANDLES[uuid]] = callback
+
+    def char_write_handle(self, handle, value, wait_for_response=False):
+        """Start (0x64, 'd') or stop (0x68, 'h') streaming."""
+        if list(value) == [0x02, 0x64, 0x0a]:
+            if not self.streaming.is_set():
+                self.streaming.set()
+                self.thread = Thread(target=self._stream)
+                self.thread.daemon = True
+                self.thread.start()
+        elif list(value) == [0x02, 0x68, 0x0a]:
+            self.streaming.clear()
+
+    def disconnect(self):
+        self.streaming.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _generate(self, n_frames):
+        """Generate raw samples [n_frames, 5 channels, 12 samples].
+
+        10 Hz alpha rhythm plus noise, around the 2048 mid-scale value.
+        """
+        t = (self.frames_sent * EEG_SAMPLES_PER_PACKET +
+             np.arange(n_frames * EEG_SAMPLES_PER_PACKET)) / 256.
+        signal = 100 * np.sin(2 * np.pi * 10 * t)
+        raw = 2048 + signal[np.newaxis, :] + \
+            20 * self.rng.randn(len(EEG_ORDER), len(t))
+        raw = np.clip(np.round(raw), 0, 4095).astype(np.int64)
+        return raw.reshape(len(EEG_ORDER), n_frames,
+                           EEG_SAMPLES_PER_PACKET).transpose(1, 0, 2)
+
+    def _stream(self):
+        """Send frames until stopped."""
+        block = 64  # frames generated and encoded at once
+        if self.rate:
+            period = EEG_SAMPLES_PER_PACKET / (256. * self.rate)
+        start = time()
+
+        while self.streaming.is_set():
+            n_frames = block
+            if self.n_frames is not None:
+                n_frames = min(block, self.n_frames - self.frames_sent)
+                if n_frames <= 0:
+                    break
+            raw = self._generate(n_frames)
+
+            # One packet per frame and channel, in the order of EEG_ORDER
+            handles = np.tile(EEG_ORDER, n_frames)
+            tm = np.repeat(self.frames_sent + np.arange(n_frames), 5) & 0xFFFF
+            samples = raw[:, [(h - 32) // 3 for h in EEG_ORDER], :]
+            packets = pack_eeg_packets(tm, samples.reshape(-1, 12))
+
+            order = np.arange(len(handles))
+            for i in np.where(self.rng.rand(len(order) - 1) <
+                              self.reorder)[0]:
+                order[i], order[i + 1] = order[i + 1], order[i]
+            keep = self.rng.rand(len(order)) >= self.loss
+            self.packets_lost += int(np.sum(~keep))
+
+            for i_frame in range(n_frames):
+                if self.rate:
+                    wait = start + (self.frames_sent + 1) * period - time()
+                    if wait > 0:
+                        sleep(wait)
+                    if not self.streaming.is_set():
+                        return
+                for i in order[i_frame * 5:(i_frame + 1) * 5]:
+                    if keep[i]:
+                        self.callbacks[handles[i]](
+                                handles[i],
+                                bytearray(packets[i * 20:(i + 1) * 20]))
+                self.frames_sent += 1
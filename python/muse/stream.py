@@ -0,0 +1,63 @@
+from threading import Lock
+
+import numpy as np
+from pylsl import StreamInfo, StreamOutlet, local_clock
+
+
+CHANNEL_NAMES = ['TP9', 'AF7', 'AF8', 'TP10', 'Right AUX']
+
+
+def create_outlet(address, name='Muse', chunk_size=12):
+    """Create the LSL outlet of a Muse, identified by its address."""
+    info = StreamInfo(name, 'EEG', 5, 256, 'float32', 'Muse%s' % address)
+
+    info.desc().append_child_value("manufacturer", "Muse")
+    channels = info.desc().append_child("channels")
+
+    for c in CHANNEL_NAMES:
+        channels.append_child("channel") \
+            .append_child_value("label", c) \
+            .append_child_value("unit", "microvolts") \
+            .append_child_value("type", "EEG")
+    return StreamOutlet(info, chunk_size, 360)
+
+
+class ChunkPublisher():
+    """Accumulate Muse frames and push them to the outlet as one chunk.
+
+    process runs in the notification thread of the backend and flush may be
+    called from another thread, so both hold the same lock.
+    """
+
+    def __init__(self, outlet, n_frames=1, max_latency=None):
+        self.outlet = outlet
+        self.max_latency = max_latency
+        self.chunk = np.zeros((12 * n_frames, 5), dtype=np.float32)
+        self.timestamps = np.zeros(12 * n_frames)
+        self.n_samples = 0
+        self.lock = Lock()
+
+    def process(self, data, timestamps):
+        """Muse callback: data is [5 channels, 12 samples]."""
+        with self.lock:
+            n = self.n_samples
+            self.chunk[n:n + 12] = data.T
+            self.timestamps[n:n + 12] = timestamps
+            self.n_samples += 12
+
+            if self.n_samples == len(self.timestamps) or (
+                    self.max_latency is not None and
+                    local_clock() - self.timestamps[0] >= self.max_latency):
+                self._push()
+
+    def flush(self):
+        """Push the accumulated samples with their own timestamps."""
+        with self.lock:
+            self._push()
+
+    def _push(self):
+        """Push the accumulated samples, the lock must be held."""
+        if self.n_samples:
+            self.outlet.push_chunk(self.chunk[:self.n_samples],
+                                   self.timestamps[:self.n_samples])
+            self.n_samples = 0